@@ -3,16 +3,25 @@
 import os
 import sys
 import re
-import array
-import fileinput
-import array
 import shutil
-import math
+import time
+import random
+import numpy as np
 from random import randrange
+from multiprocessing import Pool
+import imodmodel
+import imodselect
+import scratch
 from optparse import OptionParser
-from subprocess import Popen, call, PIPE
+from subprocess import Popen, PIPE
 from sys import stderr, exit, argv
 
+# Errors in the edit options or in an individual model file. When editing a single
+# model, these are reported with usage(); in --manifest mode they are reported for
+# the model that caused them, and the remaining models are still edited.
+class EdmodError(Exception):
+    pass
+
 # Print erorr messages and exit
 def usage(errstr):
     print ""
@@ -22,46 +31,6 @@ def usage(errstr):
     print ""
     exit(1)
 
-# Convert IMOD model file to ASCII using imodinfo
-def mod2ascii(mod_in, ascii_out):
-    handle = open(ascii_out, "w+")
-    cmd = "imodinfo -a {0}".format(mod_in)
-    call(cmd.split(), stdout = handle)
-    return handle
-
-# Parse through a text file until the regexp is matched. Once a match occurs,
-# return the entire line and break the loop.
-def matchLine(regexp, handle):
-    for line in handle:
-        if re.match(regexp, line):
-            return line
-            break
-        else:
-            continue
-        break
-
-# Parse through the object list given by --objects. Remove any entries whose
-# values are greater than the actual number of objects in the model file (if, for
-# example, these were added to the list accidentally). Append individual object
-# numbers to an array
-def parseObjectList(objstr, objarray, objmax):
-    objsplit = objstr.split(",")
-    for i in range(0, len(objsplit)):
-        if "-" not in objsplit[i]:
-            val = int(objsplit[i])
-            if val < objmax:
-                objarray.append(val)
-        else:
-            objrange1 = int(objsplit[i].split("-")[0])
-            objrange2 = int(objsplit[i].split("-")[1])
-            if objrange2 > objrange1:
-                for j in range(objrange1, objrange2 + 1 ):
-                    if j < objmax:
-                        objarray.append(j)
-            else:
-                usage("Improper object string %s." % objstr)
-    return objarray
-
 # Parse the color string input by either --colorin or --colorout. These should be
 # in one of two formats (1) "R,G,B" where each are values from 0-1, or (2) "rand", where
 # rand specifies the color should be random. A value of "rand" is only valid for the
@@ -75,122 +44,478 @@ def parseColorString(str):
         rgbstr = "color %s %s %s" % (rgb[0], rgb[1], rgb[2])
         return rgbstr, 3
     else:
-        usage("Color strings must be specified as R,G,B.")
-
-# Determines the object type of a given ASCII model file. Open objects have a line that
-# begins with "open" following the "color" line. Scattered objects have a line that begins
-# with "scattered" following the "open" line. Closed objects have neither. objtype = 1 for
-# closed, objtype = 2 for open, and objtype = 3 for scattered.
-def getObjectType(handle):
-    for line in handle:
-        if re.match("^color", line):
-            line2 = next(handle)
-            line3 = next(handle)
-            break
-        else:
+        raise EdmodError("Color strings must be specified as R,G,B.")
+
+# Determines which objects need to be removed based on the values given to --rmempty
+# and --rmbycont. Returns a boolean array with one entry per object in the table.
+def rmObjCheck(table, opts):
+    ncont = table["ncont"]
+    rmcheck = np.zeros(len(ncont), bool)
+    if opts.rmempty:
+        rmcheck |= ncont == 0
+    if opts.rmcont:
+        rmcheck |= ncont <= int(opts.rmcont)
+    return rmcheck
+
+# Removes contours that have a number of points less than or equal to the value given by
+# --rmbypoint. The point counts of all contours are compared at once, and the contour
+# table is filtered in a single step. Returns the number of contours removed.
+def rmSmallContours(obj, opts):
+    keep = obj.contours.sizes() > int(opts.rmpoint)
+    obj.contours = obj.contours.select(keep)
+    return len(keep) - int(keep.sum())
+
+# Returns a random R,G,B color
+def randomColor():
+    return tuple(float(randrange(0, 101)) / 100 for i in range(3))
+
+# Chooses the color given by --colorout for each object to edit. Random colors are
+# drawn here, in object order, so that they do not depend on how the objects are
+# later processed. Objects that keep their color get None.
+def outputColors(edit, opts, colorout):
+    colors = [None] * len(edit)
+    if opts.colorout:
+        for i in np.flatnonzero(edit):
+            if colorout is None:
+                colors[i] = randomColor()
+            else:
+                colors[i] = colorout
+    return colors
+
+# Applies the property changes given by --colorout, --nameout, --linewidth, --filled,
+# --notfilled, --pointsize and --transparency to an object. color is the new color of
+# the object, or None to keep its color.
+def replaceProperties(obj, opts, color):
+    if color is not None:
+        obj.color = color
+    if opts.transparency:
+        obj.header["trans"] = int(opts.transparency)
+    if opts.nameout:
+        obj.name = opts.nameout
+    if opts.linewidth:
+        obj.header["linewidth2"] = int(opts.linewidth)
+    if opts.filled:
+        obj.header["symflags"] = 1
+    elif opts.notfilled:
+        obj.header["symflags"] = 0
+    if opts.pointsize:
+        obj.header["pdrawsize"] = int(opts.pointsize)
+
+# Applies the per-object edits to an object selected for editing: removes contours
+# that have a number of points less than that specified by --rmbypoint, then modifies
+# the object's properties as desired.
+def editObject(obj, opts, color):
+    if opts.rmpoint:
+        rmSmallContours(obj, opts)
+    replaceProperties(obj, opts, color)
+
+# Worker for --jobs. Reads a run of consecutive objects starting at a byte offset of
+# the input model, edits them and converts them to the bytes to write to the output
+# model. edits holds a (remove, edit, color) entry for each object. Returns the list
+# of object bytes, with None for removed objects, and, for the last run of the model,
+# the model-level chunks that follow the objects.
+def editObjects(task):
+    file_in, offset, edits, opts, last = task
+    reader = imodmodel.ModelReader(file_in)
+    reader.seek(offset)
+    objects = reader.objects()
+    results = []
+    for remove, edit, color in edits:
+        obj = next(objects)
+        if remove:
+            results.append(None)
             continue
-        break
-    if re.match("^open", line2):
-        objtype = 2
-        if re.match("^scattered", line3):
-            objtype = 3
+        if edit:
+            editObject(obj, opts, color)
+        results.append(obj.tobytes())
+    extra = None
+    if last:
+        for obj in objects:
+            pass
+        extra = reader.model.extra
+    reader.close()
+    return results, extra
+
+# Determines which objects need to be removed based on the volume, surface area and
+# sphericity thresholds. Returns a boolean array with one entry per object in the table.
+def filterObjects(table, opts):
+    vol = table["volume"]
+    sa = table["area"]
+    spher = table["sphericity"]
+    filtered = np.zeros(len(vol), bool)
+    if opts.vlow:
+        filtered |= vol < float(opts.vlow)
+    if opts.vhigh:
+        filtered |= vol > float(opts.vhigh)
+    if opts.slow:
+        filtered |= sa < float(opts.slow)
+    if opts.shigh:
+        filtered |= sa > float(opts.shigh)
+    if opts.spherlow:
+        filtered |= spher < float(opts.spherlow)
+    if opts.spherhigh:
+        filtered |= spher > float(opts.spherhigh)
+    return filtered
+
+# Evaluates all of the object selection options at once over the object table.
+# objects selects the objects given by --objects, filtered the objects removed by the
+# volume/surface area filters, and query is the compiled --where expression, if any.
+# Objects ignored because of their type are neither removed nor edited. Returns two
+# boolean arrays: the objects to remove from the model, and the objects to edit.
+def selectObjects(table, opts, objects, colorin, filtered, query):
+    objtype = table["type"]
+    ignored = np.zeros(len(objtype), bool)
+    if opts.ignoreclosed:
+        ignored |= objtype == imodmodel.TYPE_CLOSED
+    if opts.ignoreopen:
+        ignored |= objtype == imodmodel.TYPE_OPEN
+    if opts.ignorescat:
+        ignored |= objtype == imodmodel.TYPE_SCATTERED
+    candidates = objects & ~ignored
+
+    # Narrow the selection down by --colorin, --namein and --where. Colors are compared
+    # to the precision that IMOD displays them with.
+    matched = candidates.copy()
+    if opts.colorin:
+        rgb = np.column_stack((table["red"], table["green"], table["blue"]))
+        matched &= (np.abs(rgb - colorin) <= 0.005).all(axis = 1)
+    if opts.namein:
+        regexp = re.compile(opts.namein)
+        matched &= np.array([regexp.match(name) is not None for name in table["name"]],
+                            bool)
+    if query is not None:
+        matched &= query(table)
+
+    # If --rmall is given, remove objects independent of --colorin, --namein and
+    # --where. Otherwise, only remove objects that also satisfy these.
+    if opts.rmall:
+        scope = candidates
     else:
-        objtype = 1
-    return objtype
-
-# Determines if an object needs to be removed based on the value given to --rmcont. First
-# reads the number of objects in the file, then makes a decision based on this value. If
-# necessary, the value is removed from the array and returned.
-def rmObjCheck(rmarray, handle, opts, i):
-    line = matchLine("^object", handle)
-    ncont = line.split()[2]
-    if opts.rmempty and int(ncont) == 0:
-        rmarray.append(i+1)
-    if opts.rmcont and int(ncont) <= int(opts.rmcont):
-        rmarray.append(i+1)
-    return rmarray
-
-# Removes contours that have less than the number of points given by --rmbypoint. Read 
-# through the file line by line. When a line beginning with "contour" is found, increment
-# the contsum counter. IF the contour has less than the number of points, increment the
-# C counter, DO NOT print the line, and flip contswitch. If it has at least the correct 
-# number of points, do not increment the C counter and DO print the line. For lines that
-# do not begin with "contour", print the line if contswitch is off. Otherwise do not print
-# the line. After the entire file has been parsed, update the "object" line with the total
-# number of new contours.
-def rmSmallContours(file_in, opts, handle):
-    C = 0
-    contsum = 0
-    contswitch = 0
-    for line in fileinput.input(file_in + ".txt", inplace = True):
-        if not re.match("^contour", line):
-            if not contswitch:
-                sys.stdout.write(line)
-            else:
+        scope = matched
+    remove = (filtered & ~ignored) | (scope & rmObjCheck(table, opts))
+    edit = matched & ~remove
+    return remove, edit
+
+# Size of the blocks of lines read and written by AsciiRewriter
+ASCII_BLOCK = 1 << 22
+
+# Rewrites the object properties of an ASCII model as it is streamed from one file to
+# another. The model is read in blocks of about ASCII_BLOCK bytes, and the lines that
+# start with the keyword of a property to replace are located in each block with plain
+# string searches; each such line is dispatched on its keyword to a handler that returns
+# the replacement line. Point and contour lines, which make up nearly all of a model,
+# are never looked at individually and are copied straight through with their block.
+class AsciiRewriter(object):
+    def __init__(self, opts, spec):
+        self.opts = opts
+        self.colorstr = None
+        if spec.colortypeout == 3:
+            self.colorstr = spec.colorstrout
+        self.handlers = {}
+        if opts.colorout or opts.transparency:
+            self.handlers["color"] = self.replaceColor
+        if opts.nameout:
+            self.handlers["name"] = self.replaceLine("name " + opts.nameout)
+        if opts.linewidth:
+            self.handlers["width2D"] = self.replaceLine("width2D " + opts.linewidth)
+        if opts.filled:
+            self.handlers["symflags"] = self.replaceLine("symflags 1")
+        elif opts.notfilled:
+            self.handlers["symflags"] = self.replaceLine("symflags 0")
+        if opts.pointsize:
+            self.handlers["pointsize"] = self.replaceLine("pointsize " + opts.pointsize)
+
+    # Returns a handler that replaces the whole line with text
+    def replaceLine(self, text):
+        return lambda words: text
+
+    # Replaces the R,G,B values of a color line with those given by --colorout, or with
+    # a random color, and its transparency with that given by --transparency
+    def replaceColor(self, words):
+        if not self.opts.colorout:
+            colorstr = " ".join(words[:4])
+        elif self.colorstr is not None:
+            colorstr = self.colorstr
+        else:
+            colorstr = "color %0.2f %0.2f %0.2f" % randomColor()
+        if self.opts.transparency:
+            return "%s %s" % (colorstr, self.opts.transparency)
+        return " ".join([colorstr] + words[4:])
+
+    # Returns the start of every line of a block that begins with a handled keyword
+    def keywordLines(self, block):
+        starts = []
+        for key in self.handlers:
+            if block.startswith(key):
+                starts.append(0)
+            key = "\n" + key
+            pos = block.find(key)
+            while pos >= 0:
+                starts.append(pos + 1)
+                pos = block.find(key, pos + 1)
+        starts.sort()
+        return starts
+
+    def rewriteBlock(self, block):
+        parts = []
+        last = 0
+        for start in self.keywordLines(block):
+            end = block.find("\n", start)
+            if end < 0:
+                end = len(block)
+            words = block[start:end].split()
+            handler = self.handlers.get(words[0])
+            if handler is None:
                 continue
+            parts.append(block[last:start])
+            parts.append(handler(words))
+            last = end
+        if not parts:
+            return block
+        parts.append(block[last:])
+        return "".join(parts)
+
+    # Copy fin to fout, replacing property lines. Blocks are extended to the end of a
+    # line so that no line is split between blocks.
+    def rewrite(self, fin, fout):
+        if not self.handlers:
+            shutil.copyfileobj(fin, fout, ASCII_BLOCK)
+            return
+        while True:
+            block = fin.read(ASCII_BLOCK)
+            if not block:
+                break
+            if not block.endswith("\n"):
+                block = block + fin.readline()
+            fout.write(self.rewriteBlock(block))
+
+# The edits given on the command line, parsed once and shared by every model edited in
+# one run. Raises EdmodError if any of the options are invalid.
+class EditSpec(object):
+    def __init__(self, opts):
+        if opts.rmcont and opts.rmempty:
+            raise EdmodError("The option --rmcont is incompatible with the option "
+                             "--rmempty")
+        if opts.rmall and not (opts.rmcont or opts.rmempty):
+            raise EdmodError("The option --rmall requires either --rmcont or --rmempty.")
+
+        self.query = None
+        if opts.where:
+            try:
+                self.query = imodselect.compileQuery(opts.where)
+            except imodselect.QueryError as e:
+                raise EdmodError("Improper expression for --where: {0}".format(e))
+
+        # Volumes and surface areas are only needed by the filters or by --where.
+        # Scattered objects have none, and are always ignored by the filters.
+        self.metrics = 0
+        if (opts.vlow or opts.vhigh or opts.slow or opts.shigh or opts.spherlow or
+           opts.spherhigh):
+            self.metrics = 1
+            opts.ignorescat = True
+        if self.query is not None and self.query.fields & set(imodselect.METRIC_FIELDS):
+            self.metrics = 1
+
+        # (OPTIONAL) Check the units for the volume/surface area filters and --where.
+        # Without --units, the units of the model header are used.
+        self.units = None
+        if opts.unit:
+            self.units = opts.unit
+            if self.units == "pix":
+                self.units = "pixels"
+            if self.units not in ("nm", "um", "pixels"):
+                raise EdmodError("Improper unit string for --units.")
+
+        # (OPTIONAL) Parse color strings
+        self.colorin = None
+        if opts.colorin:
+            colorstrin, colortypein = parseColorString(opts.colorin)
+            if colortypein == 1:
+                raise EdmodError("Input to --colorin must be specified as R,G,B.")
+            self.colorin = [float(c) for c in opts.colorin.split(",")]
+        self.colorout = None
+        self.colorstrout = 0
+        self.colortypeout = 0
+        if opts.colorout:
+            self.colorstrout, self.colortypeout = parseColorString(opts.colorout)
+            if self.colortypeout == 3:
+                self.colorout = [float(c) for c in opts.colorout.split(",")]
+
+# Edits a single model file according to the edit spec, and writes the result to
+# file_out. jobs is the number of worker processes to use for the per-object work.
+# Raises EdmodError if the model cannot be edited.
+def editModel(file_in, file_out, opts, spec, jobs):
+    path_out = os.path.dirname(file_out)
+    if not path_out:
+        path_out = os.getcwd()
+    base_out = os.path.basename(file_out)
+
+    # Check validity of positional arguments
+    if not os.path.isfile(file_in):
+        raise EdmodError("The input file {0} does not exist".format(file_in))
+
+    if not os.path.isdir(path_out):
+        raise EdmodError("The output path {0} does not exist.".format(path_out))
+
+    # The output is written to a scratch workspace of our own first, since the input
+    # and output models may be the same file, and then moved to the output path
+    work = scratch.fromOptions(opts, "edmod")
+    try:
+        # (OPTIONAL) If the --all option is selected, perform the desired changes by
+        # streaming the ASCII model once in its entirety. This is faster. A binary
+        # model is converted by imodinfo on the fly; an ASCII model is read directly.
+        if opts.all:
+            rewriter = AsciiRewriter(opts, spec)
+            with open(file_in, "rb") as fid:
+                binary = fid.read(4) == imodmodel.IMOD_ID
+            # An ASCII model takes up about four times the space of a binary one
+            size = os.path.getsize(file_in)
+            if binary:
+                size = size * 4
+            file_tmp = work.path(base_out, size)
+            with open(file_tmp, "w", ASCII_BLOCK) as fout:
+                if binary:
+                    proc = Popen(["imodinfo", "-a", file_in], stdout = PIPE,
+                                 bufsize = ASCII_BLOCK, universal_newlines = True)
+                    rewriter.rewrite(proc.stdout, fout)
+                    proc.stdout.close()
+                    if proc.wait() != 0:
+                        raise EdmodError("imodinfo failed to convert {0}".format(file_in))
+                else:
+                    with open(file_in, "r") as fin:
+                        rewriter.rewrite(fin, fout)
+            work.move(file_tmp, file_out)
+            return
+
+        # Read the model header to get the total number of objects and the units
+        model = imodmodel.readModelInfo(file_in)
+        nobj = int(model.header["objsize"][0])
+        if spec.units and model.units == "pixels" and spec.units != "pixels":
+            raise EdmodError("Model header units must be set to {0}".format(spec.units))
+
+        # (OPTIONAL) If the --objects option is seleted, select the desired objects. If it
+        # is not selected, select all objects in the model file.
+        if opts.objects:
+            try:
+                objects = imodselect.parseObjectList(opts.objects, nobj)
+            except imodselect.QueryError as e:
+                raise EdmodError(str(e))
         else:
-            contsum = contsum + 1
-            if int(line.split()[3]) <= int(opts.rmpoint):
-                C = C + 1
-                contswitch = 1
-            else:
-                contsplit = line.split()
-                contnum = int(contsplit[1])
-                line = "contour %d %s %s\n"  %(contnum - C, contsplit[2], contsplit[3])
-                contswitch = 0
-                sys.stdout.write(line)
-    if C is not 0:
-        handle.seek(0)
-        objswitch = 0
-        for line in fileinput.input(file_in + ".txt", inplace = True):
-            if not objswitch and re.match("^object", line):
-                objsplit = line.split()
-                line = "object %s %s %s\n" %(objsplit[1], contsum - C, objsplit[3])
-                objswitch = 1
-            sys.stdout.write(line)
-    return C
-
-# Takes each line of an ASCII model file as input. Checks for all possible modifications,
-# and makes the replacements when necessary.
-def matchAndReplace(line, opts, colorstrout, colortypeout):
-    if opts.colorout and re.match('^color', line):
-        line = replaceColor(line, opts, colorstrout, colortypeout)
-    elif opts.nameout and re.match('^name', line):
-        line = re.sub('^name.+', "name " + opts.nameout, line)
-    elif opts.linewidth and re.match('^width2D', line):
-        line = re.sub('^width2D.+', "width2D " + opts.linewidth, line)
-    elif opts.filled and re.match('^symflags', line):
-        line = re.sub('^symflags.+', 'symflags 1', line)
-    elif opts.notfilled and re.match('^symflags', line):
-        line = re.sub('^symflags.+', 'symflags 0', line)
-    elif opts.pointsize and re.match('^pointsize', line):
-        line = re.sub('^pointsize.+', "pointsize " + opts.pointsize, line)
-    return line
-
-# Edits color lines to have the correct specified color and/or transparency values. When
-# "rand" is supplied to --colorout, determine the random colored values based on the 
-# range given by the line number.
-def replaceColor(line, opts, colorstr, colortype):
-    if colortype == 3 and not opts.transparency:
-        line = re.sub('^color\s\S*\s\S*\s\S*\s', colorstr + " ", line)
-    elif colortype == 1 and not opts.transparency:
-        line = re.sub('^color\s\S*\s\S*\s\S*\s', "color %0.2f %0.2f %0.2f " %
-                     (float(randrange(0,fileinput.lineno())) / fileinput.lineno(),
-                     float(randrange(0,fileinput.lineno())) / fileinput.lineno(),
-                     float(randrange(0,fileinput.lineno())) / fileinput.lineno()),
-                     line)
-    elif colortype == 3 and opts.transparency:
-        line = re.sub('^color.+', colorstr + " " + opts.transparency, line)
-    elif colortype == 1 and opts.transparency:
-        line = re.sub('^color.+', "color %0.2f %0.2f %0.2f %s" %
-                     (float(randrange(0,fileinput.lineno())) / fileinput.lineno(),
-                     float(randrange(0,fileinput.lineno())) / fileinput.lineno(),
-                     float(randrange(0,fileinput.lineno())) / fileinput.lineno(),
-                     opts.transparency), line)
-    return line
+            objects = np.ones(nobj, bool)
+
+        # Build the object table in one pass over the model, then evaluate the
+        # selection over all objects at once.
+        table = imodselect.objectTable(file_in, spec.metrics, spec.units)
+        filtered = filterObjects(table, opts)
+        remove, edit = selectObjects(table, opts, objects, spec.colorin, filtered,
+                                     spec.query)
+
+        ##########
+        ## MAIN LOOP
+        ##########
+
+        # Read the model one object at a time, apply all of the edits to each object
+        # as it passes, and write it straight to the output model.
+        colors = outputColors(edit, opts, spec.colorout)
+        file_tmp = work.path(base_out, os.path.getsize(file_in))
+        offsets = table["offset"]
+        nobj = len(offsets)
+        if jobs > 1 and nobj > 0:
+            # (OPTIONAL) Split the objects into runs that are read, edited and
+            # converted by a pool of worker processes. Results come back in the
+            # original object order and are written as they arrive.
+            writer = imodmodel.ModelWriter(file_tmp, model)
+            size = max(1, min(64, nobj // (jobs * 4)))
+            tasks = []
+            for first in range(0, nobj, size):
+                last = min(first + size, nobj)
+                edits = list(zip(remove[first:last], edit[first:last],
+                                 colors[first:last]))
+                tasks.append((file_in, offsets[first], edits, opts, last == nobj))
+            pool = Pool(jobs)
+            for results, extra in pool.imap(editObjects, tasks):
+                for data in results:
+                    if data is not None:
+                        writer.writeBytes(data)
+            pool.close()
+            pool.join()
+            writer.close(extra)
+        else:
+            reader = imodmodel.ModelReader(file_in)
+            writer = imodmodel.ModelWriter(file_tmp, reader.model)
+            for i, obj in enumerate(reader.objects()):
+                if remove[i]:
+                    continue
+                if edit[i]:
+                    editObject(obj, opts, colors[i])
+                writer.write(obj)
+            writer.close(reader.model.extra)
+        work.move(file_tmp, file_out)
+    finally:
+        work.cleanup()
+
+# Reads the manifest given by --manifest. Each line gives an input and an output model
+# file, separated by whitespace. Blank lines and lines starting with # are skipped.
+def readManifest(file_manifest):
+    pairs = []
+    with open(file_manifest) as handle:
+        for n, line in enumerate(handle):
+            split = line.split()
+            if not split or split[0].startswith("#"):
+                continue
+            if len(split) != 2:
+                raise EdmodError("Line {0} of the manifest {1} must give an input and "
+                                 "an output model.".format(n + 1, file_manifest))
+            pairs.append((split[0], split[1]))
+    return pairs
+
+# Worker for --manifest. Edits one model, and returns the input and output models, the
+# time taken and an error message, which is None if the model was edited successfully.
+# Each model gets its own random colors, rather than those of the forked parent.
+def batchEdit(task):
+    file_in, file_out, opts = task
+    random.seed()
+    start = time.time()
+    error = None
+    try:
+        editModel(file_in, file_out, opts, EditSpec(opts), 1)
+    except Exception as e:
+        error = "{0}: {1}".format(e.__class__.__name__, e)
+    return file_in, file_out, time.time() - start, error
+
+# Edits all models of a manifest with the same edits, using a shared pool of jobs
+# worker processes with one model per worker at a time. Reports the time taken for
+# each model as it finishes, along with any failures. Returns the number of models
+# that failed.
+def runBatch(pairs, opts, jobs):
+    tasks = [(file_in, file_out, opts) for file_in, file_out in pairs]
+    start = time.time()
+    failed = []
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap_unordered(batchEdit, tasks)
+    else:
+        results = (batchEdit(task) for task in tasks)
+    for file_in, file_out, elapsed, error in results:
+        if error is None:
+            print "{0} -> {1}: {2:.2f} s".format(file_in, file_out, elapsed)
+        else:
+            print "{0} -> {1}: FAILED after {2:.2f} s ({3})".format(file_in, file_out,
+                                                                  elapsed, error)
+            failed.append(file_in)
+    if jobs > 1:
+        pool.close()
+        pool.join()
+    print ""
+    print "{0} of {1} models edited in {2:.2f} s".format(len(pairs) - len(failed),
+                                                        len(pairs), time.time() - start)
+    if failed:
+        print "Failed: {0}".format(" ".join(failed))
+    return len(failed)
 
 if __name__ == "__main__":
-    p = OptionParser(usage = "%prog [options] file_in.mod file_out.mod")
+    p = OptionParser(usage = "%prog [options] file_in.mod file_out.mod\n"
+                             "       %prog [options] --manifest manifest.txt")
 
     p.add_option("--colorin", dest = "colorin", metavar = "R,G,B",
                  help = "Color to change, given as R,G,B values ranging "
@@ -259,7 +584,8 @@ if __name__ == "__main__":
 
     p.add_option("--units", dest = "unit", metavar ="STR",
                  help = "Units for the low and high volume cutoffs. Available "
-                        "options are: pix, nm, um. Default units are pix.")
+                        "options are: pix, nm, um. Default units are those of "
+                        "the model header.")
 
     p.add_option("--rmbycont", dest = "rmcont", metavar = "INT",
                  help = "Removes all objects that have a number of contours "
@@ -287,239 +613,66 @@ if __name__ == "__main__":
     p.add_option("--ignoreclosed", action = "store_true", dest = "ignoreclosed",
                  help = "Ignores closed object.")
 
+    p.add_option("--where", dest = "where", metavar = "EXPR",
+                 help = "Select objects with an expression over the fields index, "
+                        "name, red, green, blue, type, ncont, npoint, volume, area "
+                        "and sphericity, e.g. \"type==closed and ncont>2 and "
+                        "name~mito\". Fields are compared with ==, !=, <, <=, >, "
+                        ">= or matched to a regular expression with ~, and "
+                        "combined with and, or, not and parentheses. Volumes and "
+                        "surface areas are given in the units of --units.")
+
+    p.add_option("--jobs", dest = "jobs", metavar = "INT",
+                 help = "Number of worker processes used to edit objects in "
+                        "parallel. The output is identical to that of a serial "
+                        "run. With --manifest, this is the number of models "
+                        "edited in parallel instead. (DEFAULT = 1)")
+
+    p.add_option("--manifest", dest = "manifest", metavar = "FILE",
+                 help = "Edit many models with the same options. Each line of "
+                        "FILE gives an input and an output model file, separated "
+                        "by whitespace; blank lines and lines starting with # are "
+                        "skipped. The input and output models are then not given "
+                        "on the command line. The time taken for each model and "
+                        "any failures are reported.")
+
     p.add_option("--all", action = "store_true", dest = "all",
                  help = "Use this argument to change the values for all "
                         "objects in the input model file.")
 
-    (opts, args) = p.parse_args()
+    scratch.addOptions(p)
 
-    # Parse the positional arguments
-    if len(args) is not 2:
+    (opts, args) = p.parse_args()
+    scratch.handleSignals()
+
+    # Parse the positional arguments, or the list of models given by --manifest
+    if opts.manifest:
+        if len(args) is not 0:
+            usage("Input and output models cannot be given with --manifest.")
+        if not os.path.isfile(opts.manifest):
+            usage("The manifest file {0} does not exist".format(opts.manifest))
+    elif len(args) is not 2:
         usage("Improper number of arguments. See the usage below.")
-    file_in = args[0]
-    file_out = args[1]
-    path_out = os.path.dirname(file_out)
-    if not path_out:
-        path_out = os.getcwd()
-    path_tmp = os.path.join(path_out, "tmp")
-    base_out = os.path.basename(file_out)
-
-    # Check validity of positional arguments
-    if not os.path.isfile(file_in):
-        usage("The input file {0} does not exist".format(file_in))
-
-    if not os.path.isdir(path_out):
-        usage("The output path {0} does not exist.".format(path_out))
 
     # Check validity of optional arguments
-    if opts.rmcont and opts.rmempty:
-        usage("The option --rmcont is incompatible with the option --rmempty")
- 
-    if opts.rmall and not (opts.rmcont or opts.rmempty):
-        usage("The option --rmall requires either --rmcont or --rmempty.")
-
-    # Create temporary directory in the output path
-    if os.path.isdir(path_tmp):
-        usage("There is already a folder with the name tmp in the output "
-              "path {0}".format(path_out))
-    os.makedirs(path_tmp)
-
-    # Set switches
-    checkobjtype = 0
-    objmodsswitch = 0
-    runimodinfo = 0
-    if (opts.colorout or opts.nameout or opts.linewidth or opts.filled or
-       opts.notfilled or opts.pointsize or opts.transparency):
-        objmodsswitch = 1
-    if opts.vlow or opts.vhigh or opts.slow or opts.shigh or opts.spherlow or opts.spherhigh:
-        runimodinfo = 1
-        opts.ignorescat = True
-    if opts.ignorescat or opts.ignoreopen or opts.ignoreclosed:
-        checkobjtype = 1
-
-    # Initialize arrays
-    rmarray = array.array('l')
-    objarray = array.array('l')
-    filterarray = array.array('l')
-    ignorearray = array.array('l')
-
-    # Convert entire model to ASCII format 
-    asciifile = os.path.join(path_tmp, file_in.split('.')[0] + ".txt")
-    handle = mod2ascii(file_in, asciifile)
-
-    # Parse the ASCII file to get the total number of objects and the units
-    handle.seek(0)
-    line = matchLine("^imod", handle)
-    nobj = int(line.split()[1])
-    line = matchLine("^units", handle)
-    modunit = line.split()[1]
-    if not opts.all:
-        handle.close()
-        os.remove(asciifile)
-
-    # (OPTIONAL) Get volume/surface area of all objects
-    if runimodinfo:
-        if not opts.unit:
-            opts.unit = modunit
-        if ((opts.unit != "nm") and (opts.unit != "um") and
-           (opts.unit != "pix") and (opts.unit != "pixels")):
-            usage("Improper unit string for --units.")
-        if modunit is "pix" or "pixels"  and (opts.unit is "nm" or opts.unit is "um"):
-            usage("Model header units must be set to {0}".format(opts.unit))
-        infofile = os.path.join(path_tmp, 'imodinfo.txt')
-        infohandle = open(infofile, "w+")
-        cmd = "imodinfo -c {0}".format(file_in)
-        call(cmd.split(), stdout = infohandle)
-        infohandle.seek(0)
-        line = matchLine("#-", infohandle)
-        C = 0
-        if modunit == "nm" and opts.unit == "um":
-            scale = 0.001
-        elif modunit == "um" and opts.unit == "nm":
-            scale = 1000
-        else:
-            scale = 1
-        for line in infohandle:
-            split = line.split()
-            if len(split) == 8:
-                C = C + 1
-                vol = float(split[3]) * (scale**3)
-                sa = float(split[4]) * (scale**2)
-                if opts.spherlow or opts.spherhigh:
-                    if sa == 0:
-                        spher = 0
-                    else:
-                        spher = (math.pi**(1.0/3) * (6*vol)**(2.0/3))/sa
-                if ((opts.vlow and vol < float(opts.vlow)) or
-                   (opts.vhigh and vol > float(opts.vhigh)) or
-                   (opts.slow and sa < float(opts.slow)) or
-                   (opts.shigh and sa > float(opts.shigh)) or
-                   (opts.spherlow and spher < float(opts.spherlow)) or
-                   (opts.spherhigh and spher > float(opts.spherhigh))):
-                    filterarray.append(C)
-        infohandle.close()
-        os.remove(infofile)
-
-    # (OPTIONAL) If the --objects option is seleted, initiate a new array that 
-    # contains the desired objects. If it is not selected, set this array to 
-    # contain a list of all objects in the model file.
-    if opts.objects:
-        objarray = parseObjectList(opts.objects, objarray, nobj)
-    else:
-        for i in range(0, nobj):
-            objarray.append(i+1)
-
-    # (OPTIONAL) Parse color strings
-    if opts.colorin:
-        colorstrin, colortypein = parseColorString(opts.colorin)
-        if colortypein == 1:
-            usage("Input to --colorin must be specified as R,G,B.")
-    if opts.colorout:
-        colorstrout, colortypeout = parseColorString(opts.colorout)
-
-    # (OPTIONAL) If the --all option is selected, perform the desired changes by 
-    # parsing through the ASCII model file once in its entirety. This is faster.
-    if opts.all:
-        handle.seek(0)
-        for line in fileinput.input(asciifile, inplace = True):
-            if opts.colorout:
-                line = matchAndReplace(line, opts, colorstrout, colortypeout)
-            else:
-                line = matchAndReplace(line, opts, 0, 0)
-            sys.stdout.write(line)
-        handle.close()
-        os.rename(asciifile, os.path.join(path_out, file_out))
-        os.rmdir(path_tmp) 
-        sys.exit(0)
-
-    ##########
-    ## MAIN LOOP 
-    ##########
-
-    for i in range(0, nobj):
-        # Extract the object to a new model file, then convert it to ASCII
-        objfile = os.path.join(path_tmp, "obj_" + str(i+1).zfill(8))
-        cmd = "imodextract {0} {1} {2}".format(i+1, file_in, objfile + ".mod")
-        call(cmd.split())
-        handle = mod2ascii(objfile + ".mod", objfile + ".txt")
-        os.remove(objfile + ".mod")
-        handle.seek(0)
-
-        # (OPTIONAL) Determine the object type. 
-        if checkobjtype:
-            objtype = getObjectType(handle)
-            if ((opts.ignoreclosed and objtype == 1) or (opts.ignoreopen and objtype == 2) or
-               (opts.ignorescat and objtype == 3)):
-                ignorearray.append(i+1)
-            handle.seek(0)
-        if i+1 in filterarray and not i+1 in ignorearray:
-            rmarray.append(i+1)
-            os.remove(objfile + ".txt")
-            continue      
- 
-        # (OPTIONAL) If --rmall is given, look for objects to remove BEFORE
-        # updating objarray based on --colorin or --namein. 
-        if opts.rmall and (opts.rmempty or opts.rmcont) and i+1 in objarray and not i+1 in ignorearray:
-            rmarray = rmObjCheck(rmarray, handle, opts, i)
-
-        # (OPTIONAL) Check the object to see if it satisfies the arguments given by --colorin
-        # and/or --namein. If it does, keep it in objarray. If it doesn't, remove it from
-        # objarray.
-        if (opts.colorin or opts.namein) and i+1 in objarray and not i+1 in ignorearray:
-            colorswitch = 0
-            nameswitch = 0
-            for line in handle:
-                if opts.colorin and re.match(colorstrin, line):
-                    colorswitch = 1
-                elif opts.namein and re.match("^name " + opts.namein, line):
-                    nameswitch = 1
-                elif re.match("^contour", line):
-                    break
-            if (opts.colorin and not colorswitch) or (opts.namein and not nameswitch):
-                objarray.remove(i + 1)
-
-        # If the --rmall argument was not given, look for ojbects to remove AFTER updating
-        # the objarray based on --colorin or --namein
-        if not opts.rmall and (opts.rmempty or opts.rmcont) and i+1 in objarray and not i+1 in ignorearray:
-            handle.seek(0)
-            rmarray = rmObjCheck(rmarray, handle, opts, i)
-
-        # (OPTIONAL) Parse through individual contours, and remove contours that have a number
-        # of points less than that specified by --rmbypoint.
-        if opts.rmpoint and i+1 in objarray and not i+1 in ignorearray:
-            handle.seek(0)
-            C = rmSmallContours(objfile, opts, handle)
-    
-    handle.close()
- 
-    # Loop over each entry remaining in objarray. For each entry, load the corresponding
-    # ASCII model file, and modify it as desired.
-    if objmodsswitch:
-        for i in range(0, len(objarray)):
-            if i+1 in rmarray or i+1 in ignorearray:
-                continue
-            objfile = os.path.join(path_tmp, "obj_" + str(objarray[i]).zfill(8) + ".txt")
-            for line in fileinput.input(objfile, inplace = True):
-                if opts.colorout:
-                    line = matchAndReplace(line, opts, colorstrout, colortypeout)
-                else:
-                    line = matchAndReplace(line, opts, 0, 0)
-                sys.stdout.write(line)
-
-    # Combine all files
-    objstr = ""
-    C=0
-    for i in range(0, nobj):
-        if not i + 1 in rmarray:
-            objfile = os.path.join(path_tmp, "obj_" + str(i + 1).zfill(8))
-            os.rename(objfile + ".txt", objfile + ".mod")
-            objstr = objstr + objfile + ".mod" + " "
-            C = C +1
-    if C == 1:
-        cmd = "mv %s%s" % (objstr, file_out)
+    jobs = 1
+    if opts.jobs:
+        jobs = int(opts.jobs)
+        if jobs < 1:
+            usage("The option --jobs must be at least 1.")
+    try:
+        spec = EditSpec(opts)
+        if opts.manifest:
+            pairs = readManifest(opts.manifest)
+    except EdmodError as e:
+        usage(str(e))
+
+    if opts.manifest:
+        nfailed = runBatch(pairs, opts, jobs)
+        if nfailed:
+            exit(1)
     else:
-        cmd = "imodjoin %s%s" %(objstr, file_out)
-    call(cmd.split())
-    shutil.rmtree(path_tmp)
-    if os.path.isfile(file_out + "~"):
-        os.remove(file_out + "~")
+        try:
+            editModel(args[0], args[1], opts, spec, jobs)
+        except EdmodError as e:
+            usage(str(e))
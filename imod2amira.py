@@ -10,11 +10,32 @@ mesh will appear in the correct location relative to the MRC file.
 import os
 import sys
 import re
-import fileinput
 import shutil
+import glob
+import time
+from multiprocessing import Pool
 from optparse import OptionParser
 from subprocess import Popen, call, PIPE
 from sys import stderr, exit, argv
+import numpy as np
+import imodmodel
+import mrcio
+import scratch
+
+# The line opening a point [ ... ] block of a VRML file
+POINT_BLOCK = re.compile(r"^[ \t]*point\b[^\n]*\n", re.M)
+
+# Mesh output formats written by writeMesh, and the extension of each
+MESH_FORMATS = {"surf": ".surf", "ply": ".ply", "stl": ".stl"}
+
+# Data types of PLY vertex coordinates for each precision
+PLY_PRECISION = {"single": ("float", "<f4"), "double": ("double", "<f8")}
+
+# Errors in converting a single model. When converting one model, these are reported
+# with usage(); in batch mode they are reported for the model that caused them, and
+# the remaining models are still converted.
+class ConversionError(Exception):
+    pass
 
 # Print error messages and exit
 def usage(errstr):
@@ -25,51 +46,6 @@ def usage(errstr):
     print ""
     exit(1)
 
-# Parse through a text file until the regexp is matched. Once a match occurs,
-# return the entire line and break the loop.
-def matchLine(regexp, fid):
-    for line in fid:
-        if re.match(regexp, line.lstrip()):
-            return line
-            break
-        else:
-            continue
-        break
-
-# Convert IMOD model file to ASCII using imodinfo
-def mod2ascii(mod_in, ascii_out):
-    handle = open(ascii_out, "w+")
-    cmd = "imodinfo -a {0}".format(mod_in)
-    call(cmd.split(), stdout = handle)
-    return handle
-
-# Get header info from an input MRC stack
-def getMrcStackInfo(file_mrc, string):
-    cmd = "header -{0} {1}".format(string, file_mrc)
-    headerout = Popen(cmd.split(), stdout = PIPE).communicate()[0]
-    header = headerout.split()
-    # If the numbers are in scientific notation, IMOD's header will sometimes 
-    # output them without spaces. In this case, find where the '+'s occur, and
-    # split in this way.
-    if len(header) is not 3:
-        for i in range(0, len(header)):
-            headerstr = header[i]
-            positionOfPlusSigns = findPositions(headerstr, '+')
-            initialPos = 0
-            if len(positionOfPlusSigns) is 0:
-                header.append(headerstr)
-            else:
-                for j in range(0, len(positionOfPlusSigns)):
-                    finalPos = positionOfPlusSigns[j] + 3
-                    header.append(headerstr[initialPos:finalPos])
-                    initialPos = finalPos
-        header = header[len(header)-3:len(header)]
-    return header
-
-# Finds all positions of a character in a given string
-def findPositions(str, char):
-    return [i for i, ltr in enumerate(str) if ltr == char]
-
 def get_blank_spaces(line):
     lineafter = line.lstrip()
     lenbefore = len(line)
@@ -78,119 +54,626 @@ def get_blank_spaces(line):
     blankspace = " " * nspaces
     return blankspace
 
+# Scale the coordinates of every point block of VRML text, such that each point
+# becomes point * scale + origin. The points of a block, which run up to the line
+# starting with the closing ], are parsed into one array, transformed at once, and
+# formatted back in a single operation, keeping the indentation of the block.
+# Returns the transformed text.
+def transformPoints(text, scale, origin):
+    scale = np.array(scale, np.float64)
+    origin = np.array(origin, np.float64)
+    parts = []
+    last = 0
+    pos = 0
+    while True:
+        match = POINT_BLOCK.search(text, pos)
+        if not match:
+            break
+        start = match.end()
+        pos = start
+        if "]" in match.group():
+            continue
+        close = text.find("]", start)
+        if close < 0:
+            close = len(text)
+        end = text.rfind("\n", start, close) + 1
+        pos = max(start, end)
+        block = text[start:end]
+        pts = np.fromstring(block.replace(",", " "), np.float64, sep = " ")
+        if len(pts) == 0:
+            continue
+        pts = pts.reshape(-1, 3) * scale + origin
+        indent = get_blank_spaces(block)
+        parts.append(text[last:start])
+        parts.append(((indent + "%0.1f %0.1f %0.1f,\n") * len(pts)) % tuple(pts.ravel()))
+        last = end
+    parts.append(text[last:])
+    return "".join(parts)
+
+# Collect the full resolution meshes of an object into a single surface, keeping
+# only the vertices used by its triangles. Returns an (N, 3) array of vertices
+# and an (M, 3) array of 0-based triangle vertex indices.
+def objectSurface(obj):
+    verts = []
+    tris = []
+    nvert = 0
+    for mesh in obj.meshes:
+        if mesh.resolution() != 0:
+            continue
+        tri = mesh.triangles()
+        used, tri = np.unique(tri, return_inverse = True)
+        verts.append(mesh.vert[used])
+        tris.append(tri.reshape(-1, 3) + nvert)
+        nvert = nvert + len(used)
+    if not verts:
+        return np.zeros((0, 3)), np.zeros((0, 3), np.int64)
+    return np.concatenate(verts), np.concatenate(tris)
+
+# Write the meshes of a model straight to a binary Amira HyperSurface (.surf) file,
+# which Amira loads as a surface without converting it. Mesh vertices are scaled to
+# match the MRC stack, such that each vertex becomes vertex * scale + origin. Each
+# object with a mesh becomes a patch of its own, whose inner region is a material
+# with the object's color. Returns the number of triangles written.
+def writeSurface(model, file_surf, scale, origin):
+    scale = np.array(scale, np.float64)
+    origin = np.array(origin, np.float64)
+    verts = []
+    patches = []
+    nvert = 0
+    for i, obj in enumerate(model.objects):
+        vert, tri = objectSurface(obj)
+        if len(tri) == 0:
+            continue
+        verts.append(vert * scale + origin)
+        patches.append(("Object{0}".format(i + 1), obj.color, tri + nvert + 1))
+        nvert = nvert + len(vert)
+    with open(file_surf, "wb") as fid:
+        fid.write("# HyperSurface 0.1 BINARY\n\n")
+        fid.write("Parameters {\n    Materials {\n")
+        fid.write("        Exterior {\n            Id 1\n        }\n")
+        for j, (name, color, tri) in enumerate(patches):
+            fid.write("        {0} {{\n            Color {1:g} {2:g} {3:g},\n"
+                      "            Id {4}\n        }}\n".format(name, color[0],
+                      color[1], color[2], j + 2))
+        fid.write("    }\n}\n\n")
+        fid.write("Vertices {0}\n".format(nvert))
+        if verts:
+            fid.write(np.concatenate(verts).astype(">f4").tobytes())
+        fid.write("\nNBranchingPoints 0\nNVerticesOnCurves 0\nBoundaryCurves 0\n")
+        fid.write("Patches {0}\n".format(len(patches)))
+        ntri = 0
+        for name, color, tri in patches:
+            fid.write("{{\nInnerRegion {0}\nOuterRegion Exterior\nBoundaryID 0\n"
+                      "BranchingPoints 0\n\nTriangles {1}\n".format(name, len(tri)))
+            fid.write(tri.astype(">i4").tobytes())
+            fid.write("\n}\n")
+            ntri = ntri + len(tri)
+    return ntri
+
+# Merge duplicate vertices of a surface through a spatial hash. Vertices are
+# snapped to a grid of spacing tol, and all vertices falling in the same cell
+# become one, placed at the first of them; with a tol of 0, only vertices with
+# identical coordinates are merged. Triangles left with less than three distinct
+# corners are dropped. Returns the merged vertices and triangles.
+def mergeVertices(vert, tri, tol = 0.0):
+    if len(vert) == 0:
+        return vert, tri
+    if tol > 0:
+        keys = np.floor(vert / tol).astype(np.int64)
+    else:
+        keys = np.ascontiguousarray(vert + 0.0)
+    keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * 3))).ravel()
+    first, index = np.unique(keys, return_index = True, return_inverse = True)[1:]
+    tri = index[tri]
+    keep = ((tri[:, 0] != tri[:, 1]) & (tri[:, 1] != tri[:, 2]) &
+            (tri[:, 0] != tri[:, 2]))
+    return vert[first], tri[keep]
+
+# Collect the meshes of a model as one indexed surface, scaled to match the MRC
+# stack such that each vertex becomes vertex * scale + origin. Duplicate vertices
+# of each object are merged with mergeVertices, so objects remain separate pieces
+# of the surface. Returns the vertices, the 0-based triangle vertex indices, and
+# the color of each triangle as bytes.
+def modelMesh(model, scale, origin, tol = 0.0):
+    scale = np.array(scale, np.float64)
+    origin = np.array(origin, np.float64)
+    verts = []
+    tris = []
+    colors = []
+    nvert = 0
+    for obj in model.objects:
+        vert, tri = objectSurface(obj)
+        vert, tri = mergeVertices(vert * scale + origin, tri, tol)
+        if len(tri) == 0:
+            continue
+        verts.append(vert)
+        tris.append(tri + nvert)
+        color = np.clip(np.round(np.array(obj.color) * 255), 0, 255)
+        colors.append(np.tile(color.astype(np.uint8), (len(tri), 1)))
+        nvert = nvert + len(vert)
+    if not verts:
+        return np.zeros((0, 3)), np.zeros((0, 3), np.int64), np.zeros((0, 3), np.uint8)
+    return np.concatenate(verts), np.concatenate(tris), np.concatenate(colors)
+
+# Write a surface as binary little-endian PLY, with vertex coordinates of the given
+# precision and the color of each face. Each face is written as a packed record of
+# its vertex count and three vertex indices. Returns the number of faces written.
+def writePly(file_ply, vert, tri, colors, precision = "single"):
+    name, dtype = PLY_PRECISION[precision]
+    face = np.zeros(len(tri), np.dtype([("n", "u1"), ("index", "<i4", (3,)),
+                                        ("color", "u1", (3,))]))
+    face["n"] = 3
+    face["index"] = tri
+    face["color"] = colors
+    with open(file_ply, "wb") as fid:
+        fid.write("ply\nformat binary_little_endian 1.0\n")
+        fid.write("comment written by imod2amira.py\n")
+        fid.write("element vertex {0}\n".format(len(vert)))
+        for axis in "xyz":
+            fid.write("property {0} {1}\n".format(name, axis))
+        fid.write("element face {0}\n".format(len(tri)))
+        fid.write("property list uchar int vertex_indices\n")
+        fid.write("property uchar red\nproperty uchar green\nproperty uchar blue\n")
+        fid.write("end_header\n")
+        fid.write(vert.astype(dtype).tobytes())
+        fid.write(face.tobytes())
+    return len(tri)
+
+# Write a surface as binary STL, whose triangles carry their own corners and unit
+# normal in single precision. Returns the number of triangles written.
+def writeStl(file_stl, vert, tri):
+    corners = vert[tri]
+    normal = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    length = np.sqrt(np.einsum("ij,ij->i", normal, normal))
+    normal = normal / np.where(length > 0, length, 1)[:, None]
+    facet = np.zeros(len(tri), np.dtype([("normal", "<f4", (3,)),
+                                         ("corners", "<f4", (3, 3)),
+                                         ("attr", "<u2")]))
+    facet["normal"] = normal
+    facet["corners"] = corners
+    with open(file_stl, "wb") as fid:
+        fid.write("binary STL written by imod2amira.py".ljust(80))
+        fid.write(np.array([len(tri)], "<u4").tobytes())
+        fid.write(facet.tobytes())
+    return len(tri)
+
+# Write the meshes of a model to a surface file of the given format, "surf", "ply"
+# or "stl", scaled to match the MRC stack. For PLY and STL, duplicate vertices are
+# merged within tol (see mergeVertices), and PLY vertices are written with the
+# given precision. Returns the number of triangles written.
+def writeMesh(model, file_out, fmt, scale, origin, precision = "single", tol = 0.0):
+    if fmt == "surf":
+        return writeSurface(model, file_out, scale, origin)
+    vert, tri, colors = modelMesh(model, scale, origin, tol)
+    if fmt == "ply":
+        return writePly(file_out, vert, tri, colors, precision)
+    return writeStl(file_out, vert, tri)
+
+# Collect the points of the scattered objects of a model, scaled to match the MRC
+# stack such that each point becomes point * scale + origin, along with their radii
+# scaled by the X scale. Points without a size of their own have the object's point
+# size. Returns a list of (object number, object, points, radii) for each scattered
+# object with points, where objects are numbered from 1.
+def scatteredPoints(model, scale, origin):
+    scale = np.array(scale, np.float64)
+    origin = np.array(origin, np.float64)
+    objects = []
+    for i, obj in enumerate(model.objects):
+        if obj.type != imodmodel.TYPE_SCATTERED or obj.npoints() == 0:
+            continue
+        pts = obj.contours.pts.astype(np.float64) * scale + origin
+        radii = obj.contours.pointSizes(obj.header["pdrawsize"][0]) * scale[0]
+        objects.append((i + 1, obj, pts, radii))
+    return objects
+
+# Write the scattered objects of a model as VRML with a single sphere per object,
+# defined once with a radius of 1 and the object's color, and placed at every point
+# with USE, scaled by the radius of the point. Returns the number of points written.
+def writeInstancedVrml(model, file_wrl, scale, origin):
+    npts = 0
+    with open(file_wrl, "w") as fid:
+        fid.write("#VRML V2.0 utf8\n\n")
+        for i, obj, pts, radii in scatteredPoints(model, scale, origin):
+            color = obj.color
+            trans = int(obj.header["trans"][0]) / 100.0
+            fid.write("Transform {{\n  translation {0:0.1f} {1:0.1f} {2:0.1f}\n"
+                      "  scale {3:g} {3:g} {3:g}\n".format(pts[0, 0], pts[0, 1],
+                      pts[0, 2], radii[0]))
+            fid.write("  children DEF Sphere{0} Shape {{\n    appearance Appearance {{\n"
+                      "      material Material {{ diffuseColor {1:g} {2:g} {3:g} "
+                      "transparency {4:g} }}\n    }}\n    geometry Sphere {{ radius 1 }}\n"
+                      "  }}\n}}\n".format(i, color[0], color[1], color[2], trans))
+            use = ("Transform { translation %0.1f %0.1f %0.1f scale %g %g %g "
+                   "children USE Sphere" + str(i) + " }\n")
+            rest = np.column_stack((pts[1:], np.repeat(radii[1:, None], 3, 1)))
+            fid.write((use * len(rest)) % tuple(rest.ravel()))
+            npts = npts + len(pts)
+    return npts
+
+# Write the scattered objects of a model as a binary Amira point cluster (HxCluster)
+# file, which holds the coordinates, radius and object number of every point in
+# flat arrays. Returns the number of points written.
+def writeCluster(model, file_am, scale, origin):
+    objects = scatteredPoints(model, scale, origin)
+    npts = sum(len(pts) for i, obj, pts, radii in objects)
+    if objects:
+        pts = np.concatenate([pts for i, obj, pts, radii in objects])
+        radii = np.concatenate([radii for i, obj, pts, radii in objects])
+        objnum = np.concatenate([np.repeat(i, len(pts)) for i, obj, pts, radii in objects])
+    else:
+        pts = np.zeros((0, 3))
+        radii = np.zeros(0)
+        objnum = np.zeros(0)
+    with open(file_am, "wb") as fid:
+        fid.write("# AmiraMesh BINARY 1.0\n\n")
+        fid.write("define Points {0}\n\n".format(npts))
+        fid.write("Parameters {\n    ContentType \"HxCluster\"\n}\n\n")
+        fid.write("Points { float[3] Coordinates } @1\n")
+        fid.write("Points { int Ids } @2\n")
+        fid.write("Points { float Radius } @3\n")
+        fid.write("Points { int Object } @4\n\n")
+        fid.write("# Data section follows\n")
+        for n, data in enumerate((pts.astype(">f4"), np.arange(1, npts + 1, dtype = ">i4"),
+                                  radii.astype(">f4"), objnum.astype(">i4"))):
+            fid.write("@{0}\n".format(n + 1))
+            fid.write(data.tobytes())
+            fid.write("\n")
+    return npts
+
+# Scale the spheres that imod2vrml2 writes for scattered points, in VRML text, to
+# match the MRC stack. Sphere centers are scaled like points, with Z divided by
+# the model's Z scale, and radii by the X scale. Returns the transformed text.
+def transformSpheres(text, scale, origin, zscale):
+    lines = text.splitlines(True)
+    for i, line in enumerate(lines):
+        if re.match("^translation", line.lstrip()): 
+            # Scale the sphere center to match the input MRC file
+            blankspace = get_blank_spaces(line)
+            line = line.split()
+            coordx = float(line[1]) * float(scale[0]) + float(origin[0])
+            coordy = float(line[2]) * float(scale[1]) + float(origin[1]) 
+            coordz = float(line[3]) * float(scale[2])/zscale + float(origin[2]) 
+            lines[i] = '%stranslation %0.1f %0.2f %0.1f\n' % (blankspace, coordx, coordy, coordz)
+        elif re.match("^geometry", line.lstrip()):
+            # Scale the sphere radius to match the input MRC file
+            blankspace = get_blank_spaces(line)
+            line = line.split()
+            line[6] = str(float(line[6]) * float(scale[0]))
+            lines[i] = blankspace + ' '.join(line) + "\n"
+    return "".join(lines)
+
+# Run imod2vrml2 on a model file and return the VRML text. The output is read
+# from a pipe, by having imod2vrml2 write to /dev/stdout, so that it never
+# touches the disk. If that fails, it is written to a scratch file instead.
+def readVrml(file_mod):
+    if os.path.exists("/dev/stdout"):
+        proc = Popen(["imod2vrml2", file_mod, "/dev/stdout"], stdout = PIPE)
+        text = proc.communicate()[0]
+        if proc.returncode == 0 and text.startswith("#VRML"):
+            return text
+    with scratch.Workspace(prefix = "imod2amira") as work:
+        file_wrl = work.path(os.path.basename(file_mod) + ".wrl")
+        call(["imod2vrml2", file_mod, file_wrl])
+        with open(file_wrl) as fid:
+            return fid.read()
+
+# Convert a model file to a VRML file whose points are scaled by transformPoints.
+# The VRML file is written once.
+def convertVrml(file_mod, file_wrl, scale, origin):
+    text = transformPoints(readVrml(file_mod), scale, origin)
+    with open(file_wrl, "w") as fid:
+        fid.write(text)
+
+# Converts a model file to a VRML file, or, with mesh, its meshes to a surface file
+# of that format (see writeMesh), scaled to match an MRC stack with the given pixel
+# scale and origin. Scattered objects are left out of surface files, and precision
+# and tol apply to PLY and STL. Models with scattered objects are converted by
+# imod2vrml2 when spheres is "vrml"; otherwise their points are written as
+# instanced VRML spheres ("instanced") or as an Amira point cluster ("cluster").
+# With verbose, the way the model is processed is printed. Returns the
+# time spent in imod2vrml2 and the number of bytes written.
+def convertModel(file_in, file_out, scale, origin, mesh = None, verbose = True,
+                 spheres = "vrml", precision = "single", tol = 0.0):
+    if not os.path.isfile(file_in):
+        raise ConversionError("The input file {0} does not exist".format(file_in))
+    scale = [float(s) for s in scale]
+
+    # Get the Z scale from the model file. Also check for object type.
+    try:
+        if mesh or spheres != "vrml":
+            model = imodmodel.readModel(file_in)
+            objects = model.objects
+        else:
+            reader = imodmodel.ModelReader(file_in, points = False)
+            model = reader.model
+            objects = reader.objects()
+        types = [obj.type for obj in objects]
+    except imodmodel.ImodError as e:
+        raise ConversionError(str(e))
+    modelzscale = float(model.header["zscale"][0])
+    typeOpen = imodmodel.TYPE_OPEN in types
+    typeScat = imodmodel.TYPE_SCATTERED in types
+
+    # (OPTIONAL) Write the meshes straight to a surface file. Mesh Z values are in
+    # slices, so they are not divided by the model's Z scale. Scattered objects
+    # have no surface, so they are left out.
+    if mesh:
+        if typeScat:
+            scat = [i for i, t in enumerate(types) if t == imodmodel.TYPE_SCATTERED]
+            print "Skipping scattered objects of {0}: {1}".format(file_in,
+                  ", ".join(str(i + 1) for i in scat))
+            model = imodmodel.subModel(model, [i for i, t in enumerate(types)
+                                               if t != imodmodel.TYPE_SCATTERED])
+        ntri = writeMesh(model, file_out, mesh, scale, origin, precision, tol)
+        if ntri == 0:
+            raise ConversionError("The model {0} does not contain any "
+                                  "meshes.".format(file_in))
+        return 0.0, os.path.getsize(file_out)
+
+    # (OPTIONAL) Write the points of scattered objects straight from the model. Sphere
+    # centers are in slices in Z, so they are not divided by the model's Z scale.
+    if typeScat and spheres != "vrml":
+        if verbose:
+            print "Processing as scattered type object."
+        if spheres == "instanced":
+            writeInstancedVrml(model, file_out, scale, origin)
+        else:
+            writeCluster(model, file_out, scale, origin)
+        return 0.0, os.path.getsize(file_out)
+
+    # First, convert the IMOD model file to vrml using the IMOD program. Its output
+    # is transformed in memory and written to the output file once.
+    start = time.time()
+    text = readVrml(file_in)
+    converter = time.time() - start
+
+    if (typeOpen and not typeScat) or (not typeOpen and not typeScat):
+        # Scale the coordinates of the VRML appropriately so that it will load into
+        # the proper position when loaded with the corresponding MRC file.
+        if verbose:
+            print "Processing as closed type object."
+        text = transformPoints(text, [scale[0], scale[1], scale[2] / modelzscale],
+                               origin)
+    elif typeScat:
+        if verbose:
+            print "Processing as scattered type object."
+        text = transformSpheres(text, scale, origin, modelzscale)
+    with open(file_out, "w") as fid:
+        fid.write(text)
+    return converter, len(text)
+
+# Reads the models to convert in batch mode. path is either a directory, in which case
+# all of its .mod files are converted, or a manifest giving one model per line,
+# optionally followed by the name of its output file. Blank lines and lines starting
+# with # are skipped. Outputs without a name are written to path_out, named after the
+# model with the extension ext. Returns a list of (model, output) pairs.
+def readBatch(path, path_out, ext):
+    if os.path.isdir(path):
+        lines = [[f] for f in sorted(glob.glob(os.path.join(path, "*.mod")))]
+    else:
+        with open(path) as handle:
+            lines = [line.split() for line in handle]
+    pairs = []
+    for n, split in enumerate(lines):
+        if not split or split[0].startswith("#"):
+            continue
+        if len(split) > 2:
+            raise ConversionError("Line {0} of the manifest {1} must give a model "
+                                  "and, optionally, an output file.".format(n + 1, path))
+        if len(split) == 2:
+            pairs.append((split[0], split[1]))
+        else:
+            base = os.path.splitext(os.path.basename(split[0]))[0]
+            pairs.append((split[0], os.path.join(path_out, base + ext)))
+    outputs = set()
+    for file_in, file_out in pairs:
+        if file_out in outputs:
+            raise ConversionError("More than one model would be written to "
+                                  "{0}".format(file_out))
+        outputs.add(file_out)
+    return pairs
+
+# Worker for --batch. Converts one model, and returns the input and output files, the
+# time taken, the time spent in imod2vrml2, the number of bytes written and an error
+# message, which is None if the model was converted successfully.
+def batchConvert(task):
+    file_in, file_out, scale, origin, mesh, spheres, precision, tol = task
+    start = time.time()
+    converter = 0.0
+    nbytes = 0
+    error = None
+    try:
+        converter, nbytes = convertModel(file_in, file_out, scale, origin, mesh, False,
+                                         spheres, precision, tol)
+    except Exception as e:
+        error = "{0}: {1}".format(e.__class__.__name__, e)
+    return file_in, file_out, time.time() - start, converter, nbytes, error
+
+# Converts all models of a batch against the same MRC stack, using a pool of jobs
+# worker processes. Reports the time taken, the time spent in imod2vrml2 and the
+# output throughput of each model as it finishes, so that runs bound by the converter
+# can be told from runs bound by I/O, along with any failures. Returns the number of
+# models that failed.
+def runBatch(pairs, scale, origin, mesh, spheres, precision, tol, jobs):
+    tasks = [(file_in, file_out, scale, origin, mesh, spheres, precision, tol)
+             for file_in, file_out in pairs]
+    start = time.time()
+    failed = []
+    total = 0
+    totalconverter = 0.0
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap_unordered(batchConvert, tasks)
+    else:
+        results = (batchConvert(task) for task in tasks)
+    for file_in, file_out, elapsed, converter, nbytes, error in results:
+        if error is None:
+            mb = nbytes / 1e6
+            print "{0} -> {1}: {2:.2f} s ({3:.2f} s in imod2vrml2), {4:.1f} MB at " \
+                  "{5:.1f} MB/s".format(file_in, file_out, elapsed, converter, mb,
+                                        mb / max(elapsed, 1e-6))
+            total = total + nbytes
+            totalconverter = totalconverter + converter
+        else:
+            print "{0} -> {1}: FAILED after {2:.2f} s ({3})".format(file_in, file_out,
+                                                                  elapsed, error)
+            failed.append(file_in)
+    if jobs > 1:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    print ""
+    print "{0} of {1} models converted in {2:.2f} s, {3:.1f} MB at {4:.1f} MB/s " \
+          "({5:.2f} s in imod2vrml2 over all jobs)".format(len(pairs) - len(failed),
+          len(pairs), elapsed, total / 1e6, total / 1e6 / max(elapsed, 1e-6),
+          totalconverter)
+    if failed:
+        print "Failed: {0}".format(" ".join(failed))
+    return len(failed)
+
 if __name__ == "__main__":
-    p = OptionParser(usage = "%prog [options] file.mrc file_in.mod file_out.wrl")
+    p = OptionParser(usage = "%prog [options] file.mrc file_in.mod file_out.wrl\n"
+                             "       %prog [options] --batch DIR|MANIFEST file.mrc "
+                             "path_out")
 
     p.add_option("--scale", dest = "scale", metavar = "X,Y,Z",
                  help = "Pixel scales in X,Y,Z.")
+
+    p.add_option("--surf", action = "store_true", dest = "surf",
+                 help = "Write the meshes of the model directly to a binary "
+                        "Amira surface (.surf) file instead of a VRML file. "
+                        "Amira loads these without converting them to a "
+                        "surface first. Not available for scattered objects.")
+
+    p.add_option("--ply", action = "store_true", dest = "ply",
+                 help = "Write the meshes of the model to a binary PLY file, as "
+                        "an indexed mesh with the color of each object on its "
+                        "faces. Not available for scattered objects.")
+
+    p.add_option("--stl", action = "store_true", dest = "stl",
+                 help = "Write the meshes of the model to a binary STL file. Not "
+                        "available for scattered objects.")
+
+    p.add_option("--precision", dest = "precision", metavar = "single|double",
+                 default = "single", type = "choice", choices = ["single", "double"],
+                 help = "Precision of the vertex coordinates written with --ply. "
+                        "STL files are always single precision. (DEFAULT = single)")
+
+    p.add_option("--merge", dest = "merge", metavar = "FLOAT",
+                 help = "With --ply or --stl, merge the vertices of an object that "
+                        "fall within the same cell of a grid of this spacing, in "
+                        "the units of the output. Triangles that collapse are "
+                        "dropped. (DEFAULT = 0, merging only identical vertices)")
+
+    p.add_option("--spheres", dest = "spheres", metavar = "FORMAT", default = "vrml",
+                 type = "choice", choices = ["vrml", "instanced", "cluster"],
+                 help = "Output format for models with scattered objects: 'vrml' "
+                        "converts them with imod2vrml2, with one sphere node per "
+                        "point; 'instanced' writes VRML that defines one sphere per "
+                        "object and places it at every point; 'cluster' writes a "
+                        "binary Amira point cluster (.am) with the radius of every "
+                        "point. Only scattered objects are written by the last two. "
+                        "(DEFAULT = vrml)")
+
+    p.add_option("--batch", dest = "batch", metavar = "DIR|MANIFEST",
+                 help = "Convert many models against the same MRC file. Either "
+                        "all .mod files of the directory DIR are converted, or "
+                        "the models listed in MANIFEST, one per line, each "
+                        "optionally followed by its output file. Outputs are "
+                        "otherwise written to path_out, named after their model. "
+                        "The time taken and the throughput of each model, and any "
+                        "failures, are reported.")
+
+    p.add_option("--jobs", dest = "jobs", metavar = "INT",
+                 help = "Number of models to convert in parallel in batch mode. "
+                        "(DEFAULT = 1)")
     (opts, args) = p.parse_args()
 
     # Parse the positional arguments
-    if len(args) is not 3:
-        usage("Improper number of arguments. See the usage below.")
-    file_mrc = args[0]
-    file_in = args[1]
-    file_out = args[2]
-    path_out = os.path.dirname(file_out)
+    if opts.batch:
+        if len(args) is not 2:
+            usage("Improper number of arguments. See the usage below.")
+        file_mrc = args[0]
+        path_out = args[1]
+        if not os.path.exists(opts.batch):
+            usage("The batch directory or manifest {0} does not "
+                  "exist".format(opts.batch))
+    else:
+        if len(args) is not 3:
+            usage("Improper number of arguments. See the usage below.")
+        file_mrc = args[0]
+        file_in = args[1]
+        file_out = args[2]
+        path_out = os.path.dirname(file_out)
 
-    if not path_out:
-        path_out = os.getcwd()
+        if not path_out:
+            path_out = os.getcwd()
 
-    base_out = os.path.basename(file_out)
+        base_out = os.path.basename(file_out)
+
+    mesh = None
+    formats = [fmt for fmt in ("surf", "ply", "stl") if getattr(opts, fmt)]
+    if len(formats) > 1:
+        usage("Only one of --surf, --ply and --stl may be given.")
+    if formats:
+        mesh = formats[0]
+
+    tol = 0.0
+    if opts.merge:
+        tol = float(opts.merge)
+        if tol < 0:
+            usage("The option --merge must not be negative.")
+
+    jobs = 1
+    if opts.jobs:
+        jobs = int(opts.jobs)
+        if jobs < 1:
+            usage("The option --jobs must be at least 1.")
 
     # Check validity of positional arguments
     if not os.path.isfile(file_mrc):
         usage("The input file {0} does not exit".format(file_mrc))
 
-    if not os.path.isfile(file_in):
-        usage("The input file {0} does not exist".format(file_in))
-
     if not os.path.isdir(path_out):
         usage("The output path {0} does not exist.".format(path_out))
 
+    # Read the header of the MRC stack, once for all models
+    try:
+        mrc = mrcio.readHeader(file_mrc)
+    except mrcio.MrcError as e:
+        usage(str(e))
+
     # Parse the scale option if provided. If not provided, extract scale info
-    # from the model header. Scale values are typically in Angstroms
+    # from the MRC header. Scale values are typically in Angstroms
     if opts.scale:
         scale = opts.scale.split(",")
     else:
-        scale = getMrcStackInfo(file_mrc, "pixel")
+        scale = mrc.pixel
 
     # Get origin info from mrc stack
-    origin = getMrcStackInfo(file_mrc, "origin")
-    if len(origin) is not 3:
-        print "Not 3"
-
-    # Get the Z scale from the model file. Also check for object type.
-    cmd = 'imodinfo -a {0}'.format(file_in)
-    proc = Popen(cmd.split(), stdout = PIPE)
-    typeOpen = False
-    typeScat = False
-    for line in proc.stdout:
-        if re.match('^scale', line.lstrip()):
-            modelzscale = float(line.split()[3])
-        elif re.match('^open', line.lstrip()):
-            typeOpen = True
-        elif re.match('^scattered', line.lstrip()):
-            typeScat = True
-            break
+    origin = mrc.origin
 
     # Print header info
     print "Scale (x,y,z): {0}, {1}, {2}".format(scale[0], scale[1], scale[2])
     print "Origin (x,y,z): {0}, {1}, {2}".format(origin[0], origin[1], origin[2])
 
-    # First, convert the IMOD model file to vrml using the IMOD program
-    cmd = "imod2vrml2 {0} {1}".format(file_in, file_out)
-    call(cmd.split())
-    fid = open(file_out, "r+")
-
-    if (typeOpen and not typeScat) or (not typeOpen and not typeScat):
-        # Loop through every line of the output VRML file. When necessary, scale
-        # the coordinates appropriately so that the VRML will load into the proper
-        # position when loaded with the corresponding MRC file.
-        print "Processing as closed type object."
-        coordswitch = 0
-        for line in fileinput.input(file_out, inplace = True):
-            if re.match("^point", line.lstrip()):
-                coordswitch = 1
-                sys.stdout.write(line)
-                continue
-            if re.match("\]", line.lstrip()):
-                coordswitch = 0
-                sys.stdout.write(line)
-                continue
-            if coordswitch:
-                blankspace = get_blank_spaces(line)
-                line = line.lstrip()
-                coordx = float(line.split()[0]) * float(scale[0]) + float(origin[0])
-                coordy = float(line.split()[1]) * float(scale[1]) + float(origin[1])
-                coordz = line.split()[2]
-                coordz = float(coordz.split(",")[0]) * float(scale[2])/modelzscale + float(origin[2])
-                line = "%s%0.1f %0.1f %0.1f,\n" % (blankspace, coordx, coordy, coordz)
-                sys.stdout.write(line)
-            else:
-                sys.stdout.write(line)
-    elif typeScat:
-        print "Processing as scattered type object."
-        for line in fileinput.input(file_out, inplace = True):
-            if re.match("^translation", line.lstrip()): 
-                # Scale the sphere center to match the input MRC file
-                blankspace = get_blank_spaces(line)
-                line = line.lstrip()
-                coordx = float(line.split()[1]) * float(scale[0]) + float(origin[0])
-                coordy = float(line.split()[2]) * float(scale[1]) + float(origin[1]) 
-                coordz = float(line.split()[3]) * float(scale[2])/modelzscale + float(origin[2]) 
-                line = '%stranslation %0.1f %0.2f %0.1f\n' % (blankspace, coordx, coordy, coordz)
-                sys.stdout.write(line)
-                continue
-            elif re.match("^geometry", line.lstrip()):
-                # Scale the sphere readius to match the input MRC file
-                blankspace = get_blank_spaces(line)
-                line = line.lstrip().split()
-                line[6] = str(float(line[6]) * float(scale[0]))
-                line = blankspace + ' '.join(line)
-                sys.stdout.write(line)
-                continue
-            else:
-                sys.stdout.write(line)
-    fid.close()
-    print 'Output written to {0}'.format(file_out)
+    if opts.batch:
+        ext = ".wrl"
+        if mesh:
+            ext = MESH_FORMATS[mesh]
+        elif opts.spheres == "cluster":
+            ext = ".am"
+        try:
+            pairs = readBatch(opts.batch, path_out, ext)
+        except ConversionError as e:
+            usage(str(e))
+        if runBatch(pairs, scale, origin, mesh, opts.spheres, opts.precision, tol,
+                    jobs):
+            exit(1)
+    else:
+        try:
+            convertModel(file_in, file_out, scale, origin, mesh, True,
+                         opts.spheres, opts.precision, tol)
+        except ConversionError as e:
+            usage(str(e))
+        print 'Output written to {0}'.format(file_out)
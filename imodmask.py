@@ -0,0 +1,370 @@
+"""
+Conversion between IMOD models and masks. The closed contours of a model are
+filled in-process, slice by slice, into boolean images of the size of the MRC
+stack the model was drawn on, so that no image has to be produced by imodmop
+and read back. In the other direction, the boundaries of the regions of a mask
+are traced into contours, as imodauto does, and collected for a point file.
+
+Model coordinates are in pixels, with the center of pixel (i, j) at
+(i + 0.5, j + 0.5). A pixel is inside a contour when its center is, and the
+mask of a slice is the union of all contours on it. Contours are assigned to
+the slice nearest to the Z value of their first point.
+"""
+
+import bisect
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import imodmodel
+
+# Fill closed polygons into a boolean image with a scanline fill. pts is an (N, 2)
+# array of X and Y coordinates holding the points of all polygons one after the
+# other, offsets the start of each polygon in pts followed by N, and shape the
+# number of rows and columns of the image. Every edge is intersected with the
+# centers of the rows it spans, all at once; the crossings of each polygon and row
+# are sorted, paired up into spans, and the spans accumulated as +1/-1 steps whose
+# running sum along each row marks the pixels inside any polygon.
+def fillPolygons(pts, offsets, shape):
+    nrow, ncol = shape
+    mask = np.zeros((nrow, ncol), bool)
+    sizes = np.diff(offsets)
+    poly = np.repeat(np.arange(len(sizes)), sizes)
+    keep = np.repeat(sizes >= 3, sizes)
+    if not keep.any():
+        return mask
+
+    # Each point is joined to the next point of its polygon, the last to the first
+    nxt = np.arange(1, len(pts) + 1)
+    nxt[offsets[1:] - 1] = offsets[:-1]
+    x0, y0 = pts[keep, 0], pts[keep, 1]
+    x1, y1 = pts[nxt[keep], 0], pts[nxt[keep], 1]
+    poly = poly[keep]
+
+    # Rows whose centers lie in [min(y0, y1), max(y0, y1)) are crossed by the edge
+    first = np.ceil(np.minimum(y0, y1) - 0.5).astype(np.int64)
+    last = np.ceil(np.maximum(y0, y1) - 0.5).astype(np.int64)
+    first = np.clip(first, 0, nrow)
+    last = np.clip(last, 0, nrow)
+    count = np.maximum(last - first, 0)
+    total = int(count.sum())
+    if total == 0:
+        return mask
+    edge = np.repeat(np.arange(len(count)), count)
+    start = np.cumsum(count) - count
+    row = first[edge] + np.arange(total) - start[edge]
+    x = x0[edge] + (row + 0.5 - y0[edge]) * (x1 - x0)[edge] / (y1 - y0)[edge]
+
+    # Pair up the crossings of each polygon and row into spans of columns whose
+    # centers lie in [xa, xb)
+    order = np.lexsort((x, row, poly[edge]))
+    x = x[order]
+    row = row[order][0::2]
+    cfirst = np.clip(np.ceil(x[0::2] - 0.5), 0, ncol).astype(np.int64)
+    clast = np.clip(np.ceil(x[1::2] - 0.5), 0, ncol).astype(np.int64)
+    span = clast > cfirst
+    row, cfirst, clast = row[span], cfirst[span], clast[span]
+    width = ncol + 1
+    steps = (np.bincount(row * width + cfirst, minlength = nrow * width) -
+             np.bincount(row * width + clast, minlength = nrow * width))
+    mask[:] = np.cumsum(steps.reshape(nrow, width)[:, :ncol], 1) > 0
+    return mask
+
+# The mask of the closed objects of a model over an MRC stack of size (columns,
+# rows, sections). The contours are sorted by slice once, with their points
+# reordered to match, so that the contours of any slice are a contiguous range
+# found by a binary search of the sorted Z index.
+class ModelMask(object):
+    def __init__(self, model, size):
+        self.size = tuple(int(n) for n in size)
+        pts = []
+        sizes = []
+        for obj in model.objects:
+            if obj.type != imodmodel.TYPE_CLOSED or len(obj.contours) == 0:
+                continue
+            pts.append(obj.contours.pts.astype(np.float64))
+            sizes.append(obj.contours.sizes())
+        if pts:
+            pts = np.concatenate(pts)
+            sizes = np.concatenate(sizes)
+        else:
+            pts = np.zeros((0, 3))
+            sizes = np.zeros(0, np.int64)
+        starts = np.cumsum(sizes) - sizes
+        starts = starts[sizes > 0]
+        sizes = sizes[sizes > 0]
+        z = np.floor(pts[starts, 2] + 0.5).astype(np.int64)
+
+        # Sort the contours by slice and gather their points in that order
+        order = np.argsort(z, kind = "mergesort")
+        sizes = sizes[order]
+        self.offsets = np.concatenate(([0], np.cumsum(sizes)))
+        shift = starts[order] - self.offsets[:-1]
+        self.pts = pts[np.repeat(shift, sizes) + np.arange(len(pts)), :2]
+        self.z = z[order]
+
+    # Slices that have at least one contour
+    def slices(self):
+        return np.unique(self.z)
+
+    # Return the mask of a slice as a boolean image of (rows, columns)
+    def slice(self, z):
+        first, last = np.searchsorted(self.z, [z, z + 1])
+        offsets = self.offsets[first:last + 1]
+        pts = self.pts[offsets[0]:offsets[-1]]
+        return fillPolygons(pts, offsets - offsets[0], self.size[1::-1])
+
+    # Return the mask of the whole stack as a boolean volume of (sections, rows,
+    # columns), filling each slice that has contours in a single pass over them
+    def volume(self):
+        ncol, nrow, nsec = self.size
+        vol = np.zeros((nsec, nrow, ncol), bool)
+        for z in self.slices():
+            if 0 <= z < nsec:
+                vol[z] = self.slice(z)
+        return vol
+
+# Build the mask of a model file over an MRC stack of size (columns, rows, sections)
+def readMask(file_mod, size):
+    return ModelMask(imodmodel.readModel(file_mod), size)
+
+# Segments of the boundary in a cell of four pixel centers, for each case of the
+# cell. Bits 1, 2, 4 and 8 of the case are set when the bottom left, bottom right,
+# top right and top left pixel is inside. Edges of the cell are numbered 0 to 3
+# for the bottom, right, top and left edge, and segments run from one edge to
+# another with the inside on their left. Diagonal pixels are not connected.
+CELL_SEGMENTS = {1: ((0, 3),), 2: ((1, 0),), 3: ((1, 3),), 4: ((2, 1),),
+                 5: ((0, 3), (2, 1)), 6: ((2, 0),), 7: ((2, 3),), 8: ((3, 2),),
+                 9: ((0, 2),), 10: ((1, 0), (3, 2)), 11: ((1, 2),), 12: ((3, 1),),
+                 13: ((0, 1),), 14: ((3, 0),)}
+
+# Trace the boundaries of the regions of a boolean image of (rows, columns) with
+# marching squares. Boundary points lie on the pixel edges that separate inside
+# and outside pixels, halfway between their centers, in the model coordinates of
+# the image. The segments of all cells are found at once and joined into closed
+# contours by following each point to the next, where the points of each contour
+# are found and ordered by pointer jumping. Outer boundaries run counterclockwise
+# and the boundaries of holes clockwise. Returns a list of (N, 2) arrays.
+def traceContours(img):
+    img = np.pad(np.asarray(img, bool), 1, "constant")
+    nrow, ncol = img.shape
+    case = (img[:-1, :-1] * 1 + img[:-1, 1:] * 2 + img[1:, 1:] * 4 +
+            img[1:, :-1] * 8).astype(np.int64)
+
+    # Number the horizontal edges between pixels (r, c) and (r, c + 1), followed by
+    # the vertical edges between pixels (r, c) and (r + 1, c)
+    nhoriz = nrow * (ncol - 1)
+    starts = []
+    ends = []
+    rows, cols = np.nonzero((case != 0) & (case != 15))
+    codes = case[rows, cols]
+    for code, segments in CELL_SEGMENTS.items():
+        r = rows[codes == code]
+        c = cols[codes == code]
+        edges = (r * (ncol - 1) + c, nhoriz + r * ncol + c + 1,
+                 (r + 1) * (ncol - 1) + c, nhoriz + r * ncol + c)
+        for a, b in segments:
+            starts.append(edges[a])
+            ends.append(edges[b])
+    if not starts:
+        return []
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    order = np.argsort(starts)
+    starts = starts[order]
+    succ = np.searchsorted(starts, ends[order])
+
+    # Label each point with the lowest point of its contour, then find its distance
+    # from the contour's last point, when contours are cut before their lowest point
+    n = len(succ)
+    label = np.arange(n)
+    jump = succ.copy()
+    rounds = int(np.ceil(np.log2(n + 1))) + 1
+    for k in range(rounds):
+        label = np.minimum(label, label[jump])
+        jump = jump[jump]
+    jump = succ.copy()
+    last = label[succ] == succ
+    jump[last] = np.nonzero(last)[0]
+    dist = (~last).astype(np.int64)
+    for k in range(rounds):
+        dist = dist + dist[jump]
+        jump = jump[jump]
+    order = np.lexsort((-dist, label))
+
+    # Convert edge numbers to coordinates
+    edge = starts[order]
+    horiz = edge < nhoriz
+    r = np.where(horiz, edge // (ncol - 1), (edge - nhoriz) // ncol)
+    c = np.where(horiz, edge % (ncol - 1), (edge - nhoriz) % ncol)
+    pts = np.column_stack((c + np.where(horiz, 0.0, -0.5),
+                           r + np.where(horiz, -0.5, 0.0)))
+    breaks = np.nonzero(np.diff(label[order]))[0] + 1
+    return np.split(pts, breaks)
+
+# Reduce the points of a closed contour with the Douglas-Peucker algorithm, such
+# that no point removed lies further than tol from the reduced contour. The
+# contour is split at its first point and the point furthest from it, and each
+# half is reduced as a polyline. With a tol of 0, only points lying on a straight
+# line between their neighbors are removed. Returns the reduced contour.
+def reduceContour(pts, tol):
+    n = len(pts)
+    if n < 4:
+        return pts
+    far = int(np.argmax(((pts - pts[0]) ** 2).sum(1)))
+    keep = np.zeros(n + 1, bool)
+    keep[[0, far, n]] = True
+    closed = np.concatenate((pts, pts[:1]))
+    stack = [(0, far), (far, n)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        seg = closed[last] - closed[first]
+        rel = closed[first + 1:last] - closed[first]
+        length = np.sqrt((seg ** 2).sum())
+        if length > 0:
+            dist = np.abs(seg[0] * rel[:, 1] - seg[1] * rel[:, 0]) / length
+        else:
+            dist = np.sqrt((rel ** 2).sum(1))
+        k = int(np.argmax(dist))
+        if dist[k] > tol:
+            mid = first + 1 + k
+            keep[mid] = True
+            stack.append((first, mid))
+            stack.append((mid, last))
+    return pts[keep[:n]]
+
+# Contours traced from many slices, collected in memory with their Z value and a
+# contour number that runs over all slices, from 1, so that they can be written
+# to a single point file at the end
+class ContourAccumulator(object):
+    def __init__(self):
+        self.slices = []
+        self.firsts = []
+        self.ncont = 0
+        self.npoints = 0
+
+    # Add the contours of slice z, each an (N, 2) array of X and Y
+    def add(self, z, contours):
+        contours = [cont for cont in contours if len(cont) >= 3]
+        if not contours:
+            return
+        sizes = np.array([len(cont) for cont in contours])
+        self.slices.append((z, sizes, np.concatenate(contours)))
+        self.firsts.append(self.ncont)
+        self.ncont = self.ncont + len(contours)
+        self.npoints = self.npoints + int(sizes.sum())
+
+    # Return the Z value and number of points of each contour, and the points of
+    # all contours, in the order they were added, from contour number start on,
+    # counted from 0, which must be the first contour of a slice
+    def arrays(self, start = 0):
+        slices = self.slices[bisect.bisect_left(self.firsts, start):]
+        if not slices:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros((0, 2))
+        z = np.concatenate([np.repeat(zs, len(ss)) for zs, ss, ps in slices])
+        sizes = np.concatenate([ss for zs, ss, ps in slices])
+        pts = np.concatenate([ps for zs, ss, ps in slices])
+        return z, sizes, pts
+
+    # Return the Z value and the first point of each contour, from contour number
+    # start on (see arrays)
+    def firstPoints(self, start = 0):
+        z, sizes, pts = self.arrays(start)
+        return z, pts[np.cumsum(sizes) - sizes]
+
+    # Write the contours to a point file as read by point2model, with lines of
+    # object, contour, X, Y and Z. objects gives the object number of each contour,
+    # or 0 to leave it out; by default, all contours are in object 1. Objects are
+    # written in order, each with its contours in the order they were added,
+    # numbered from 1.
+    def write(self, file_txt, objects = None):
+        z, sizes, pts = self.arrays()
+        if objects is None:
+            objects = np.ones(self.ncont, np.int64)
+        objects = np.asarray(objects, np.int64)
+        order = np.argsort(objects, kind = "mergesort")
+        order = order[objects[order] > 0]
+        counts = np.bincount(objects[order])
+        numbers = np.zeros(self.ncont, np.int64)
+        numbers[order] = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts,
+                                                           counts) + 1
+        starts = np.cumsum(sizes) - sizes
+        line = "%d %d %0.2f %0.2f %0.2f\n"
+        with open(file_txt, "w") as fid:
+            for k in range(0, len(order), 4096):
+                block = order[k:k + 4096]
+                bsizes = sizes[block]
+                index = (np.repeat(starts[block] - (np.cumsum(bsizes) - bsizes), bsizes) +
+                         np.arange(bsizes.sum()))
+                rows = np.column_stack((np.repeat(objects[block], bsizes),
+                                        np.repeat(numbers[block], bsizes), pts[index],
+                                        np.repeat(z[block], bsizes)))
+                fid.write((line * len(rows)) % tuple(rows.ravel()))
+
+# Find the label of the region each contour traced by traceContours belongs to.
+# labels is a labeled volume of (sections, rows, columns), as given by
+# scipy.ndimage.label for the masks the contours were traced from, and z and pts
+# the slice and first point of each contour. A traced point lies on the edge
+# between a pixel inside the region and one outside, whose label is 0, so the
+# larger of the two labels is the region's, also for the boundaries of holes.
+def contourLabels(labels, z, pts):
+    nsec, nrow, ncol = labels.shape
+    x = pts[:, 0]
+    y = pts[:, 1]
+    horiz = np.floor(x) == x
+    row1 = np.where(horiz, np.floor(y), y - 1).astype(np.int64)
+    col1 = np.where(horiz, x - 1, np.floor(x)).astype(np.int64)
+    row2 = np.where(horiz, row1, y).astype(np.int64)
+    col2 = np.where(horiz, x, col1).astype(np.int64)
+    result = np.zeros(len(z), labels.dtype)
+    for row, col in ((row1, col1), (row2, col2)):
+        valid = (row >= 0) & (row < nrow) & (col >= 0) & (col < ncol)
+        found = labels[z[valid], row[valid], col[valid]]
+        result[valid] = np.maximum(result[valid], found)
+    return result
+
+# Labels of the 3D connected components of a volume that is processed in slabs
+# of consecutive slices, so that only one slab is held in memory at a time. Each
+# slab is labeled on its own, together with the last halo slices of the slab
+# before it, which are labeled in both. Labels are numbered on from those of
+# earlier slabs, and the components of the two slabs that share voxels in the
+# overlap are recorded as one. resolve() then joins these into the components of
+# the whole volume, numbered in the same order as if it had been labeled at once.
+class SlabLabeler(object):
+    def __init__(self):
+        self.nlabels = 0
+        self.pairs = []
+        self.nvoxels = [np.zeros(1, np.int64)]
+
+    # Label a slab, whose first halo slices overlap the slab before it, with prev
+    # the labels those slices were given there. Voxels of the overlap are counted
+    # with the slab before. Returns the labels of the slab.
+    def label(self, slab, halo = 0, prev = None):
+        labels, n = ndimage.label(slab)
+        self.nvoxels.append(np.bincount(labels[halo:].ravel(), minlength = n + 1)[1:])
+        labels[labels > 0] += self.nlabels
+        self.nlabels = self.nlabels + n
+        if halo and prev is not None:
+            both = (labels[:halo] > 0) & (prev > 0)
+            pairs = np.column_stack((prev[both], labels[:halo][both]))
+            if len(pairs):
+                self.pairs.append(np.unique(pairs.view(np.dtype((np.void,
+                                  2 * pairs.dtype.itemsize)))).view(pairs.dtype).reshape(-1, 2))
+        return labels
+
+    # Join the labels of all slabs into components. Returns the component of each
+    # label, numbered from 1 in the order of their first voxel, with 0 for the
+    # background, and the number of voxels of each component, which is 0 for the
+    # background.
+    def resolve(self):
+        n = self.nlabels + 1
+        if self.pairs:
+            pairs = np.concatenate(self.pairs)
+        else:
+            pairs = np.zeros((0, 2), np.int64)
+        graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), (n, n))
+        ncomp, components = connected_components(graph, directed = False)
+        nvoxels = np.bincount(components, np.concatenate(self.nvoxels), ncomp)
+        return components, nvoxels.astype(np.int64)
@@ -0,0 +1,563 @@
+"""
+Reader and writer for the binary IMOD model format. A model is loaded into
+memory as an ImodModel holding a list of ImodObjects, which in turn hold their
+contours and meshes. Points and mesh data are stored as big-endian NumPy
+arrays, exactly as they appear on disk, so that a model that is read and
+written back out without modification is identical byte-for-byte.
+
+Chunks that are not interpreted (IMAT, SIZE, VIEW, MINX, etc.) are kept as raw
+(id, data) pairs attached to the model, object, contour or mesh they belong to,
+so that they follow it when objects or contours are removed.
+"""
+
+import io
+import struct
+import numpy as np
+
+# File identifiers
+IMOD_ID = b"IMOD"
+IMOD_VERSION = b"V1.2"
+ID_OBJT = b"OBJT"
+ID_CONT = b"CONT"
+ID_MESH = b"MESH"
+ID_IEOF = b"IEOF"
+ID_SIZE = b"SIZE"
+
+# Optional chunks that belong to the model as a whole rather than to the
+# object that precedes them
+MODEL_CHUNKS = (b"VIEW", b"MINX", b"MOST", b"SLAN", b"OGRP", b"MCLP", b"REFI",
+                b"IMNX")
+
+# Optional chunks that belong to an object rather than to the contour or mesh
+# that precedes them. IMOD writes these after the object's meshes.
+OBJECT_CHUNKS = (b"IMAT", b"CLIP", b"MEPA", b"OLBL", b"OBST")
+
+# Object flags
+OBJFLAG_OPEN = 1 << 3
+OBJFLAG_SCAT = 1 << 9
+
+# Object types, numbered as in edmod.py
+TYPE_CLOSED = 1
+TYPE_OPEN = 2
+TYPE_SCATTERED = 3
+
+# Model header units, given as a power of ten of meters
+UNITS = {0: "pixels", 3: "km", 1: "m", -2: "cm", -3: "mm", -6: "um",
+         -9: "nm", -10: "Angstroms", -12: "pm"}
+UNIT_CODES = dict((name, code) for code, name in UNITS.items())
+
+# Fixed size headers of the model and of each chunk type. All values are
+# stored big-endian.
+MODEL_HEADER = np.dtype([
+    ("name", "S128"), ("xmax", ">i4"), ("ymax", ">i4"), ("zmax", ">i4"),
+    ("objsize", ">i4"), ("flags", ">u4"), ("drawmode", ">i4"),
+    ("mousemode", ">i4"), ("blacklevel", ">i4"), ("whitelevel", ">i4"),
+    ("xoffset", ">f4"), ("yoffset", ">f4"), ("zoffset", ">f4"),
+    ("xscale", ">f4"), ("yscale", ">f4"), ("zscale", ">f4"),
+    ("object", ">i4"), ("contour", ">i4"), ("point", ">i4"), ("res", ">i4"),
+    ("thresh", ">i4"), ("pixsize", ">f4"), ("units", ">i4"), ("csum", ">i4"),
+    ("alpha", ">f4"), ("beta", ">f4"), ("gamma", ">f4")])
+
+OBJECT_HEADER = np.dtype([
+    ("name", "S64"), ("extra", ">u4", (16,)), ("contsize", ">i4"),
+    ("flags", ">u4"), ("axis", ">i4"), ("drawmode", ">i4"), ("red", ">f4"),
+    ("green", ">f4"), ("blue", ">f4"), ("pdrawsize", ">i4"), ("symbol", "u1"),
+    ("symsize", "u1"), ("linewidth2", "u1"), ("linewidth", "u1"),
+    ("linesty", "u1"), ("symflags", "u1"), ("sympad", "u1"), ("trans", "u1"),
+    ("meshsize", ">i4"), ("surfsize", ">i4")])
+
+CONTOUR_HEADER = np.dtype([
+    ("psize", ">i4"), ("flags", ">u4"), ("time", ">i4"), ("surf", ">i4")])
+
+MESH_HEADER = np.dtype([
+    ("vsize", ">i4"), ("lsize", ">i4"), ("flag", ">u4"), ("time", ">i2"),
+    ("surf", ">i2")])
+
+POINT = np.dtype(">f4")
+INDEX = np.dtype(">i4")
+
+# Mesh index list commands
+MESH_END = -1
+MESH_ENDPOLY = -22
+MESH_BGNPOLYNORM = -23
+MESH_BGNPOLYNORM2 = -25
+
+# Bits of the mesh flag giving the resolution of a mesh. imodmesh can store
+# lower resolution meshes of an object next to its full resolution (0) mesh.
+MESH_RES_SHIFT = 16
+MESH_RES_MASK = 0xf
+
+class ImodError(Exception):
+    pass
+
+# Read exactly n bytes from a file, raising an error if the file ends early
+def readBytes(fid, n):
+    data = fid.read(n)
+    if len(data) != n:
+        raise ImodError("Unexpected end of file in {0}".format(fid.name))
+    return data
+
+# Read a fixed size header into a writable one-element structured array
+def readHeader(fid, dtype):
+    return np.frombuffer(readBytes(fid, dtype.itemsize), dtype).copy()
+
+# Read a big-endian array of count elements
+def readArray(fid, dtype, count):
+    return np.frombuffer(readBytes(fid, dtype.itemsize * count), dtype).copy()
+
+# Read an optional chunk, which is stored as its byte count followed by data
+def readChunkData(fid):
+    size = struct.unpack(">i", readBytes(fid, 4))[0]
+    return readBytes(fid, size)
+
+# Convert a NUL-padded name field to a string
+def decodeName(raw):
+    name = raw.split(b"\0")[0]
+    if not isinstance(name, str):
+        name = name.decode("latin-1")
+    return name
+
+# A single contour. pts is an (N, 3) array of X, Y, Z coordinates. extra holds
+# optional chunks (such as per-point sizes) that follow the contour.
+class ImodContour(object):
+    def __init__(self, header = None, pts = None):
+        if header is None:
+            header = np.zeros(1, CONTOUR_HEADER)
+        if pts is None:
+            pts = np.zeros((0, 3), POINT)
+        self.header = header
+        self.pts = pts
+        self.extra = []
+
+    def write(self, fid):
+        self.header["psize"] = len(self.pts)
+        fid.write(ID_CONT)
+        fid.write(self.header.tobytes())
+        fid.write(np.asarray(self.pts, POINT).tobytes())
+        writeExtra(fid, self.extra)
+
+# All of the contours of an object, stored as a table: headers is an array of
+# contour headers, whose psize fields give the number of points in each
+# contour, and pts is a single (N, 3) array holding the points of all contours
+# one after another. The points of contour i are pts[offsets[i]:offsets[i+1]].
+# extra maps contour indices to the optional chunks that follow them. pts is
+# None for contours read without their points.
+class ContourTable(object):
+    def __init__(self, headers = None, pts = None):
+        if headers is None:
+            headers = np.zeros(0, CONTOUR_HEADER)
+            pts = np.zeros((0, 3), POINT)
+        self.headers = headers
+        self.pts = pts
+        self.extra = {}
+
+    # Build a table from a list of ImodContours
+    @classmethod
+    def fromContours(cls, contours):
+        if not contours:
+            return cls()
+        for cont in contours:
+            cont.header["psize"] = len(cont.pts)
+        headers = np.concatenate([cont.header for cont in contours])
+        pts = np.concatenate([np.asarray(cont.pts, POINT) for cont in contours])
+        table = cls(headers, pts)
+        for i, cont in enumerate(contours):
+            if cont.extra:
+                table.extra[i] = list(cont.extra)
+        return table
+
+    def __len__(self):
+        return len(self.headers)
+
+    # Yield each contour as an ImodContour whose points are a view into pts
+    def __iter__(self):
+        offsets = self.offsets()
+        for i in range(len(self)):
+            cont = ImodContour(self.headers[i:i+1])
+            if self.pts is not None:
+                cont.pts = self.pts[offsets[i]:offsets[i+1]]
+            cont.extra = self.extra.get(i, [])
+            yield cont
+
+    # Number of points in each contour
+    def sizes(self):
+        return self.headers["psize"].astype(np.int64)
+
+    def offsets(self):
+        return np.concatenate(([0], np.cumsum(self.sizes())))
+
+    def npoints(self):
+        return int(self.sizes().sum())
+
+    # Return the size (radius) of every point. Contours with a SIZE chunk give the
+    # sizes of their points, where negative values mean the default size, which
+    # all other points have.
+    def pointSizes(self, default):
+        sizes = np.full(self.npoints(), float(default))
+        offsets = self.offsets()
+        for i, chunks in self.extra.items():
+            for chunkid, data in chunks:
+                if chunkid != ID_SIZE:
+                    continue
+                values = np.frombuffer(data, POINT)[:offsets[i+1] - offsets[i]]
+                start = offsets[i]
+                sizes[start:start + len(values)] = np.where(values >= 0, values, default)
+        return sizes
+
+    # Return a new table holding only the contours where keep is True. Contours
+    # are renumbered, and their points and optional chunks follow them.
+    def select(self, keep):
+        keep = np.asarray(keep, bool)
+        table = ContourTable(self.headers[keep].copy())
+        if self.pts is not None:
+            table.pts = self.pts[np.repeat(keep, self.sizes())]
+        if self.extra:
+            newindex = np.cumsum(keep) - 1
+            table.extra = dict((int(newindex[i]), chunks)
+                               for i, chunks in self.extra.items() if keep[i])
+        return table
+
+    # Write all contours as CONT chunks. Without optional chunks, the chunks of
+    # all contours are assembled in a single buffer: the chunk ID and header of
+    # each contour are scattered to the start of its chunk, and the points fill
+    # the remaining bytes in order.
+    def write(self, fid):
+        if len(self) == 0:
+            return
+        if self.extra:
+            for cont in self:
+                cont.write(fid)
+            return
+        chunk = np.dtype([("id", "S4"), ("header", CONTOUR_HEADER)])
+        head = np.zeros(len(self), chunk)
+        head["id"] = ID_CONT
+        head["header"] = self.headers
+        size = chunk.itemsize + 3 * POINT.itemsize * self.sizes()
+        starts = np.cumsum(size) - size
+        headpos = (starts[:, None] + np.arange(chunk.itemsize)).ravel()
+        data = np.empty(int(size.sum()), np.uint8)
+        data[headpos] = head.view(np.uint8)
+        ptspos = np.ones(len(data), bool)
+        ptspos[headpos] = False
+        data[ptspos] = np.ascontiguousarray(self.pts, POINT).view(np.uint8).ravel()
+        fid.write(data.tobytes())
+
+# A single mesh. vert is an (N, 3) array of vertices (and normals), and list
+# is the index list describing the polygons.
+class ImodMesh(object):
+    def __init__(self, header = None, vert = None, list = None):
+        if header is None:
+            header = np.zeros(1, MESH_HEADER)
+        if vert is None:
+            vert = np.zeros((0, 3), POINT)
+        if list is None:
+            list = np.zeros(0, INDEX)
+        self.header = header
+        self.vert = vert
+        self.list = list
+        self.extra = []
+
+    @classmethod
+    def read(cls, fid):
+        header = readHeader(fid, MESH_HEADER)
+        vert = readArray(fid, POINT, int(header["vsize"][0]) * 3).reshape(-1, 3)
+        list = readArray(fid, INDEX, int(header["lsize"][0]))
+        return cls(header, vert, list)
+
+    def resolution(self):
+        return (int(self.header["flag"][0]) >> MESH_RES_SHIFT) & MESH_RES_MASK
+
+    # Return an (N, 3) array of vertex indices of the triangles in the mesh.
+    # imodmesh writes triangles either as vertex indices following
+    # BGNPOLYNORM2, with each normal stored right after its vertex, or as
+    # (normal, vertex) index pairs following BGNPOLYNORM.
+    def triangles(self):
+        list = np.asarray(self.list, np.int64)
+        iscmd = list < 0
+        cmdpos = np.flatnonzero(iscmd)
+        if len(cmdpos) == 0:
+            return np.zeros((0, 3), np.int64)
+        # Find the command that opened the polygon each index belongs to
+        seg = np.cumsum(iscmd) - 1
+        valid = ~iscmd & (seg >= 0)
+        seg = np.where(valid, seg, 0)
+        cmd = list[cmdpos][seg]
+        offset = np.arange(len(list)) - cmdpos[seg]
+        isvert = valid & ((cmd == MESH_BGNPOLYNORM2) |
+                          ((cmd == MESH_BGNPOLYNORM) & (offset % 2 == 0)))
+        return list[isvert].reshape(-1, 3)
+
+    def write(self, fid):
+        self.header["vsize"] = len(self.vert)
+        self.header["lsize"] = len(self.list)
+        fid.write(ID_MESH)
+        fid.write(self.header.tobytes())
+        fid.write(np.asarray(self.vert, POINT).tobytes())
+        fid.write(np.asarray(self.list, INDEX).tobytes())
+        writeExtra(fid, self.extra)
+
+# A single object, with its contours and meshes. extra holds optional chunks
+# that belong to the object (e.g. IMAT, CLIP) and are written after its meshes.
+class ImodObject(object):
+    def __init__(self, header = None):
+        if header is None:
+            header = np.zeros(1, OBJECT_HEADER)
+        self.header = header
+        self.contours = ContourTable()
+        self.meshes = []
+        self.extra = []
+        self.offset = None
+
+    def getName(self):
+        return decodeName(self.header["name"][0])
+
+    def setName(self, name):
+        self.header["name"] = name.encode("latin-1")[:63]
+
+    name = property(getName, setName)
+
+    def getColor(self):
+        return tuple(float(self.header[c][0]) for c in ("red", "green", "blue"))
+
+    def setColor(self, rgb):
+        self.header["red"], self.header["green"], self.header["blue"] = rgb
+
+    color = property(getColor, setColor)
+
+    # Returns 1 for closed, 2 for open and 3 for scattered objects
+    def getType(self):
+        flags = int(self.header["flags"][0])
+        if flags & OBJFLAG_SCAT:
+            return TYPE_SCATTERED
+        elif flags & OBJFLAG_OPEN:
+            return TYPE_OPEN
+        return TYPE_CLOSED
+
+    type = property(getType)
+
+    def npoints(self):
+        return self.contours.npoints()
+
+    def write(self, fid):
+        self.header["contsize"] = len(self.contours)
+        self.header["meshsize"] = len(self.meshes)
+        fid.write(ID_OBJT)
+        fid.write(self.header.tobytes())
+        self.contours.write(fid)
+        for mesh in self.meshes:
+            mesh.write(fid)
+        writeExtra(fid, self.extra)
+
+    # Return the object as it would be written to a model file
+    def tobytes(self):
+        fid = io.BytesIO()
+        self.write(fid)
+        return fid.getvalue()
+
+# A whole model. extra holds the model-level optional chunks (VIEW, MINX, etc.)
+# written after the last object.
+class ImodModel(object):
+    def __init__(self, header = None):
+        if header is None:
+            header = np.zeros(1, MODEL_HEADER)
+        self.header = header
+        self.version = IMOD_VERSION
+        self.objects = []
+        self.extra = []
+
+    def getUnits(self):
+        units = int(self.header["units"][0])
+        return UNITS.get(units, "pixels")
+
+    units = property(getUnits)
+
+    # X, Y and Z scaling of model coordinates in model units
+    def getScale(self):
+        pixsize = float(self.header["pixsize"][0])
+        zscale = float(self.header["zscale"][0])
+        return pixsize, pixsize, pixsize * zscale
+
+    scale = property(getScale)
+
+    # X, Y and Z scaling of model coordinates in the given units, which may be
+    # any of the names in UNITS. Scaling to pixels only applies the Z scale.
+    def unitScale(self, units):
+        if units not in UNIT_CODES:
+            raise ImodError("Unknown units {0}".format(units))
+        zscale = float(self.header["zscale"][0])
+        if units == "pixels":
+            return 1.0, 1.0, zscale
+        if self.units == "pixels":
+            raise ImodError("Model header units must be set to {0}".format(units))
+        pixsize = float(self.header["pixsize"][0])
+        pixsize = pixsize * 10.0**(int(self.header["units"][0]) - UNIT_CODES[units])
+        return pixsize, pixsize, pixsize * zscale
+
+    def write(self, fid):
+        self.header["objsize"] = len(self.objects)
+        fid.write(IMOD_ID)
+        fid.write(self.version)
+        fid.write(self.header.tobytes())
+        for obj in self.objects:
+            obj.write(fid)
+        writeExtra(fid, self.extra)
+        fid.write(ID_IEOF)
+
+# Write a list of optional (id, data) chunks
+def writeExtra(fid, extra):
+    for chunkid, data in extra:
+        fid.write(chunkid)
+        fid.write(struct.pack(">i", len(data)))
+        fid.write(data)
+
+# Read the file identifier and model header of an open model file
+def readModelHeader(fid):
+    if readBytes(fid, 4) != IMOD_ID:
+        raise ImodError("{0} is not a binary IMOD model file".format(fid.name))
+    model = ImodModel()
+    model.version = readBytes(fid, 4)
+    model.header = readHeader(fid, MODEL_HEADER)
+    return model
+
+# Read only the model header of a binary model file. The returned model has
+# no objects; the number of objects is given by header["objsize"].
+def readModelInfo(file_in):
+    with open(file_in, "rb") as fid:
+        return readModelHeader(fid)
+
+# Read a binary model file one object at a time. The model header is read
+# on opening; objects() then yields each object as soon as all of its chunks
+# have been read, so only one object is held in memory at a time. Model-level
+# chunks are collected in model.extra once objects() has been exhausted.
+# When points is False, contour points are skipped over rather than read, which
+# is much faster when only object properties and contour sizes are needed. The
+# byte offset of each object in the file is kept in obj.offset, so that it can
+# be read again later with seek().
+class ModelReader(object):
+    def __init__(self, file_in, points = True):
+        self.fid = open(file_in, "rb")
+        self.model = readModelHeader(self.fid)
+        self.points = points
+
+    def objects(self):
+        obj = None
+        extra = self.model.extra
+        while True:
+            chunkid = readBytes(self.fid, 4)
+            if chunkid == ID_IEOF:
+                break
+            elif chunkid == ID_OBJT:
+                if obj is not None:
+                    yield self.finishObject(obj, headers, pts, contextra)
+                offset = self.fid.tell() - len(ID_OBJT)
+                obj = ImodObject(readHeader(self.fid, OBJECT_HEADER))
+                obj.offset = offset
+                headers = []
+                pts = []
+                contextra = {}
+                extra = obj.extra
+            elif chunkid == ID_CONT:
+                header = readHeader(self.fid, CONTOUR_HEADER)
+                psize = int(header["psize"][0])
+                if self.points:
+                    pts.append(readArray(self.fid, POINT, psize * 3))
+                else:
+                    self.fid.seek(psize * 3 * POINT.itemsize, 1)
+                extra = contextra.setdefault(len(headers), [])
+                headers.append(header)
+            elif chunkid == ID_MESH:
+                mesh = ImodMesh.read(self.fid)
+                obj.meshes.append(mesh)
+                extra = mesh.extra
+            else:
+                if chunkid in MODEL_CHUNKS or obj is None:
+                    extra = self.model.extra
+                elif chunkid in OBJECT_CHUNKS:
+                    extra = obj.extra
+                extra.append((chunkid, readChunkData(self.fid)))
+        if obj is not None:
+            yield self.finishObject(obj, headers, pts, contextra)
+        self.close()
+
+    # Build the contour table of an object once all of its contours are read
+    def finishObject(self, obj, headers, pts, contextra):
+        if headers:
+            table = ContourTable(np.concatenate(headers), None)
+            if self.points:
+                table.pts = np.concatenate(pts).reshape(-1, 3)
+            table.extra = dict((i, chunks) for i, chunks in contextra.items() if chunks)
+            obj.contours = table
+        return obj
+
+    # Continue reading from the object at the given byte offset
+    def seek(self, offset):
+        self.fid.seek(offset)
+
+    def close(self):
+        self.fid.close()
+
+# Write a binary model file one object at a time. The header of the given
+# model is written on opening, and the object count in it is updated on
+# closing, after the model-level chunks have been written.
+class ModelWriter(object):
+    def __init__(self, file_out, model):
+        self.fid = open(file_out, "wb")
+        self.header = model.header.copy()
+        self.nobj = 0
+        self.fid.write(IMOD_ID)
+        self.fid.write(model.version)
+        self.fid.write(self.header.tobytes())
+
+    def write(self, obj):
+        obj.write(self.fid)
+        self.nobj = self.nobj + 1
+
+    # Write an object that has already been converted with ImodObject.tobytes
+    def writeBytes(self, data):
+        self.fid.write(data)
+        self.nobj = self.nobj + 1
+
+    def close(self, extra = ()):
+        writeExtra(self.fid, extra)
+        self.fid.write(ID_IEOF)
+        self.header["objsize"] = self.nobj
+        self.fid.seek(len(IMOD_ID) + len(IMOD_VERSION))
+        self.fid.write(self.header.tobytes())
+        self.fid.close()
+
+# Read an entire binary model file into memory
+def readModel(file_in):
+    reader = ModelReader(file_in)
+    model = reader.model
+    model.objects = list(reader.objects())
+    return model
+
+# Write a model to a binary model file
+def writeModel(model, file_out):
+    with open(file_out, "wb") as fid:
+        model.write(fid)
+
+# Join several binary model files into one by streaming their objects, in order,
+# into file_out. Each object is read and written once, with its contours, meshes
+# and optional chunks. The header and model-level chunks of the first model are
+# kept, and the object count is set to the total number of objects written.
+# Returns the number of objects written.
+def joinModels(files_in, file_out):
+    first = ModelReader(files_in[0])
+    writer = ModelWriter(file_out, first.model)
+    for obj in first.objects():
+        writer.write(obj)
+    for file_in in files_in[1:]:
+        for obj in ModelReader(file_in).objects():
+            writer.write(obj)
+    writer.close(first.model.extra)
+    return writer.nobj
+
+# Return a copy of a model containing only the objects at the given (0-based)
+# indices. Objects are shared with the input model, not copied.
+def subModel(model, indices):
+    sub = ImodModel(model.header.copy())
+    sub.version = model.version
+    sub.objects = [model.objects[i] for i in indices]
+    sub.extra = list(model.extra)
+    return sub
@@ -0,0 +1,264 @@
+"""
+Object selection for IMOD models. A table of per-object metadata (index, name,
+color, type, number of contours and points, and mesh volume, surface area and
+sphericity) is built in a single pass over a model file, and selection
+expressions such as
+
+    type==closed and ncont>2 and name~mito
+
+are compiled once and evaluated over all objects of the table at once.
+
+Expressions compare a field to a value with ==, !=, <, <=, > or >=, or match a
+field against a regular expression with ~, and combine comparisons with and,
+or, not and parentheses. Object types may be given as closed, open or
+scattered.
+"""
+
+import re
+import math
+import operator
+import numpy as np
+import imodmodel
+
+# Fields of the object table
+NUMERIC_FIELDS = ("index", "red", "green", "blue", "type", "ncont", "npoint",
+                  "volume", "area", "sphericity")
+STRING_FIELDS = ("name",)
+METRIC_FIELDS = ("volume", "area", "sphericity")
+
+TYPE_NAMES = {"closed": imodmodel.TYPE_CLOSED, "open": imodmodel.TYPE_OPEN,
+              "scattered": imodmodel.TYPE_SCATTERED}
+
+OPERATORS = {"==": operator.eq, "!=": operator.ne, "<": operator.lt,
+             "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+TOKEN = re.compile(r"""\s*(?:(?P<op>==|!=|<=|>=|<|>|~|\(|\))|
+                           "(?P<dquote>[^"]*)"|'(?P<squote>[^']*)'|
+                           (?P<word>[^\s()=!<>~"']+))""", re.X)
+
+class QueryError(Exception):
+    pass
+
+# Triangles accumulated by objectTable before their metrics are computed
+BATCH_TRIANGLES = 1 << 20
+
+# Compute the volumes and surface areas enclosed by the meshes of many objects
+# in one batch. meshes is a list of (object number, mesh) pairs, where objects
+# are numbered from 0, and scale gives the X, Y and Z size of a pixel. The
+# volume of each object is the sum of the signed volumes of the tetrahedra
+# formed by each of its triangles and the origin; its surface area is the sum
+# of half the lengths of the triangles' edge cross products. Returns arrays of
+# volumes and surface areas, indexed by object number, of length nobj.
+def meshMetrics(meshes, nobj, scale):
+    corners = []
+    ids = []
+    for i, mesh in meshes:
+        tri = mesh.triangles()
+        corners.append(mesh.vert[tri])
+        ids.append(np.repeat(i, len(tri)))
+    if not corners:
+        return np.zeros(nobj), np.zeros(nobj)
+    corners = np.concatenate(corners).astype(np.float64) * scale
+    ids = np.concatenate(ids)
+    a = corners[:, 0]
+    b = corners[:, 1]
+    c = corners[:, 2]
+    cross = np.cross(b - a, c - a)
+    sa = 0.5 * np.sqrt(np.einsum("ij,ij->i", cross, cross))
+    vol = np.einsum("ij,ij->i", a, np.cross(b, c)) / 6
+    vol = np.abs(np.bincount(ids, vol, nobj))
+    sa = np.bincount(ids, sa, nobj)
+    return vol, sa
+
+# Sphericity is the ratio of the surface area of a sphere with the same
+# volume as the object to the surface area of the object. Objects without a
+# surface area have a sphericity of 0.
+def sphericity(vol, sa):
+    vol = np.asarray(vol, np.float64)
+    sa = np.asarray(sa, np.float64)
+    spher = np.zeros(sa.shape)
+    nonzero = sa > 0
+    spher[nonzero] = (math.pi**(1.0/3) * (6*vol[nonzero])**(2.0/3)) / sa[nonzero]
+    return spher
+
+# Build the object table of a model file. Contour points are skipped over, and
+# the full resolution meshes are only measured when metrics is set, in which case volumes and surface
+# areas are given in units (see ImodModel.unitScale), or in model units if
+# units is not given. Otherwise these columns are zero. Meshes are collected
+# and measured in batches of about BATCH_TRIANGLES triangles. The table also
+# holds the byte offset of each object in the file, which is not selectable.
+def objectTable(file_in, metrics = False, units = None):
+    reader = imodmodel.ModelReader(file_in, points = False)
+    if units:
+        scale = np.array(reader.model.unitScale(units))
+    else:
+        scale = np.array(reader.model.scale)
+    names = []
+    offsets = []
+    rows = []
+    batch = []
+    ntri = 0
+    partial = []
+    for i, obj in enumerate(reader.objects()):
+        names.append(obj.name)
+        offsets.append(obj.offset)
+        r, g, b = obj.color
+        rows.append((r, g, b, obj.type, len(obj.contours), obj.npoints()))
+        if not metrics:
+            continue
+        for mesh in obj.meshes:
+            if mesh.resolution() != 0:
+                continue
+            batch.append((i, mesh))
+            ntri = ntri + len(mesh.list) // 3
+        if ntri >= BATCH_TRIANGLES:
+            partial.append(meshMetrics(batch, i + 1, scale))
+            batch = []
+            ntri = 0
+    nobj = len(names)
+    rows = np.array(rows, np.float64).reshape(-1, 6)
+    table = {"index": np.arange(1, nobj + 1), "name": np.array(names, object),
+             "offset": np.array(offsets, np.int64)}
+    for j, field in enumerate(("red", "green", "blue", "type", "ncont", "npoint")):
+        table[field] = rows[:, j]
+    table["volume"] = np.zeros(nobj)
+    table["area"] = np.zeros(nobj)
+    if metrics:
+        partial.append(meshMetrics(batch, nobj, scale))
+        for vol, sa in partial:
+            table["volume"][:len(vol)] += vol
+            table["area"][:len(sa)] += sa
+    table["sphericity"] = sphericity(table["volume"], table["area"])
+    return table
+
+# Split an expression into (kind, text) tokens, where kind is "op" for
+# operators and parentheses, "str" for quoted strings and "word" otherwise
+def tokenize(expr):
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = TOKEN.match(expr, pos)
+        if not match:
+            raise QueryError("Invalid expression at '{0}'".format(expr[pos:]))
+        pos = match.end()
+        if match.group("op"):
+            tokens.append(("op", match.group("op")))
+        elif match.group("word"):
+            tokens.append(("word", match.group("word")))
+        elif match.group("dquote") is not None:
+            tokens.append(("str", match.group("dquote")))
+        else:
+            tokens.append(("str", match.group("squote")))
+    return tokens
+
+# A compiled selection expression. Calling it on an object table returns a
+# boolean array with one entry per object. fields holds the table fields the
+# expression refers to.
+class Query(object):
+    def __init__(self, expr):
+        self.tokens = tokenize(expr)
+        self.pos = 0
+        self.fields = set()
+        self.func = self.parseOr()
+        if self.pos != len(self.tokens):
+            raise QueryError("Unexpected '{0}' in expression".format(
+                             self.tokens[self.pos][1]))
+
+    def __call__(self, table):
+        return np.asarray(self.func(table), bool)
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise QueryError("Unexpected end of expression")
+        self.pos = self.pos + 1
+        return token
+
+    def parseOr(self):
+        left = self.parseAnd()
+        while self.peek() == ("word", "or"):
+            self.next()
+            left = combine(np.logical_or, left, self.parseAnd())
+        return left
+
+    def parseAnd(self):
+        left = self.parseNot()
+        while self.peek() == ("word", "and"):
+            self.next()
+            left = combine(np.logical_and, left, self.parseNot())
+        return left
+
+    def parseNot(self):
+        if self.peek() == ("word", "not"):
+            self.next()
+            func = self.parseNot()
+            return lambda table: np.logical_not(func(table))
+        return self.parseAtom()
+
+    def parseAtom(self):
+        kind, text = self.next()
+        if (kind, text) == ("op", "("):
+            func = self.parseOr()
+            if self.next() != ("op", ")"):
+                raise QueryError("Missing ')' in expression")
+            return func
+        if kind != "word" or text not in NUMERIC_FIELDS + STRING_FIELDS:
+            raise QueryError("Unknown field '{0}'".format(text))
+        field = text
+        kind, op = self.next()
+        if kind != "op" or op not in OPERATORS and op != "~":
+            raise QueryError("Expected a comparison after '{0}'".format(field))
+        kind, value = self.next()
+        if kind == "op":
+            raise QueryError("Expected a value after '{0}{1}'".format(field, op))
+        self.fields.add(field)
+        return compileComparison(field, op, value)
+
+def combine(logical, left, right):
+    return lambda table: logical(left(table), right(table))
+
+# Compile a single comparison of a table field to a value
+def compileComparison(field, op, value):
+    if op == "~":
+        try:
+            regexp = re.compile(value)
+        except re.error:
+            raise QueryError("Invalid regular expression '{0}'".format(value))
+        return lambda table: np.array([regexp.search(str(v)) is not None
+                                       for v in table[field]], bool)
+    compare = OPERATORS[op]
+    if field in STRING_FIELDS:
+        return lambda table: compare(table[field], value).astype(bool)
+    if field == "type" and value in TYPE_NAMES:
+        value = TYPE_NAMES[value]
+    try:
+        value = float(value)
+    except ValueError:
+        raise QueryError("Invalid value '{0}' for {1}".format(value, field))
+    return lambda table: compare(table[field], value)
+
+# Compile a selection expression
+def compileQuery(expr):
+    return Query(expr)
+
+# Return a boolean array selecting the objects (numbered from 1) given in a
+# string such as "1,3,5-8". Objects beyond nobj are ignored.
+def parseObjectList(objstr, nobj):
+    selected = np.zeros(nobj, bool)
+    for item in objstr.split(","):
+        if "-" not in item:
+            val = int(item)
+            if 0 < val <= nobj:
+                selected[val - 1] = True
+        else:
+            first, last = [int(v) for v in item.split("-")]
+            if last <= first:
+                raise QueryError("Improper object string {0}.".format(objstr))
+            selected[max(first, 1) - 1:min(last, nobj)] = True
+    return selected
@@ -5,12 +5,20 @@ import re
 import array
 import glob
 import sys
+import shutil
+import hashlib
 import fileinput
 import numpy as np
-from scipy import misc
+from multiprocessing import Pool
 from optparse import OptionParser
 from subprocess import Popen, call, PIPE
 from sys import stderr, exit, argv
+import mrcio
+import scratch
+import imodmodel
+import imodmask
+import segstack
+import pipeline
 
 def usage(errstr):
     print ""
@@ -20,17 +28,76 @@ def usage(errstr):
     print ""
     exit(1)
 
+# Approximate bytes of memory needed per voxel of a slab: its mask, its labels and
+# the temporary arrays of labeling them
+VOXEL_BYTES = 10
+
+# Memory limit for a slab, in megabytes, when neither --slab nor --maxmem is given
+DEFAULT_MAXMEM = 1024
+
+# State shared by processSlice: the cell mask, the organelle segmentation and the
+# settings of the run. It is set up before the slices are processed, and passed
+# on to the worker processes of --jobs when they are forked.
+worker = {}
+
+# Mask and trace slice i. The organelle segmentation image imgOrg is loaded if not
+# given. Returns the slice number, the reduced contours of the masked segmentation
+# and the masked segmentation itself, in the row order of the MRC stack. Slices
+# without a cell mask give no contours and no mask.
+def processSlice(i, imgOrg = None):
+    if imgOrg is None:
+        imgOrg = worker["seg"].load(i, worker["shape"], worker["resize"])
+
+    # Get the cell mask of the slice, flipped in Y to the row order of TIFF images
+    # as mrc2tif writes them
+    imgCell = worker["mask"].slice(i)[::-1]
+    if not imgCell.any():
+        return i, [], None
+
+    # If invert is not set, then mask the image by taking the AND of the two
+    # images to produce only the organelles that lie inside of the mask.
+    # Otherwise, keep only the objects that are outside of the mask.
+    if worker["invert"]:
+        imgMask = np.greater(imgOrg, imgCell)[::-1]
+    else:
+        imgMask = np.logical_and(imgCell, imgOrg)[::-1]
+
+    # Trace the contours of the masked segmentation and reduce their points
+    traced = imodmask.traceContours(imgMask)
+    traced = [imodmask.reduceContour(cont, worker["tol"]) for cont in traced]
+    return i, traced, imgMask
+
+# Process the slices of indices, on the pool of jobs processes if one is given, or
+# else serially with the segmentation images read ahead on threads threads. Yields
+# the results of processSlice in the order of indices.
+def sliceResults(indices, pool, jobs, threads):
+    if pool is not None:
+        chunk = max(1, min(16, len(indices) // (jobs * 4)))
+        return pool.imap(processSlice, indices, chunk)
+    slicesOrg = segstack.prefetch(worker["seg"], indices, worker["shape"],
+                                  worker["resize"], threads)
+    return (processSlice(i, imgOrg) for i, imgOrg in slicesOrg)
+
+# Run an IMOD command on a copy of the model file_in written to file_out, which it
+# changes in place
+def runModelCommand(cmd, file_in, file_out):
+    shutil.copyfile(file_in, file_out)
+    if call(cmd.split() + [file_out, file_out]) != 0:
+        usage("{0} failed.".format(cmd.split()[0]))
+
 if __name__ == "__main__":
-    p = OptionParser(usage = "%prog [options] file.mrc file.mod path_seg") 
+    p = OptionParser(usage = "%prog [options] file.mrc file.mod path_seg|seg.tif|seg.mrc") 
 
     p.add_option("--invert", action = "store_true", dest = "invert",
                  help = "Inverts the mask, such that segmented objects "
                         "of the masked area are retained.") 
 
     p.add_option("-R", "--R", dest = "pointreduction", metavar = "VALUE",
-                 help = "Value for point reduction during contour generation "
-                        "with imodauto. Must be a value between 0-1, where 1 "
-                        "will remove 100% of the points.")
+                 help = "Tolerance in pixels for point reduction of the "
+                        "contours traced from the masked segmentation, as with "
+                        "imodauto -R. Points are removed while the reduced "
+                        "contour stays within this distance of them. "
+                        "(DEFAULT = 0, removing only points on straight lines)")
 
     p.add_option("-P", "--P", dest = "passes", metavar = "VALUE",
                  help = "Number of passes through empty slices to perform "
@@ -51,16 +118,72 @@ if __name__ == "__main__":
                         "total number of contours. Objects containing a number "
                         "of contours less than or equal to this value will be "
                         "removed. (DEFAULT = 2)")
+
+    p.add_option("--rmbyvoxel", dest = "rmbyvoxel", metavar = "VALUE",
+                 help = "Objects containing a number of voxels less than this "
+                        "value will be removed. (DEFAULT = 0)")
  
     p.add_option("--output", dest = "path_out", metavar = "PATH",
                  help = "Output path to save to (DEFAULT = Current directory.")
 
+    p.add_option("--maskout", dest = "maskout", metavar = "FILE",
+                 help = "Also write the masked segmentation to an MRC file of "
+                        "the same size as the MRC stack, one byte per pixel.")
+
+    p.add_option("--resize", dest = "resize", metavar = "METHOD",
+                 default = "nearest", type = "choice",
+                 choices = list(segstack.RESIZE_METHODS),
+                 help = "Method of resizing segmentation images to the size of "
+                        "the MRC stack: 'nearest' takes the nearest pixel, 'max' "
+                        "sets each pixel covered by any segmented pixel, which "
+                        "keeps thin structures when shrinking. "
+                        "(DEFAULT = nearest)")
+
+    p.add_option("--threads", dest = "threads", metavar = "INT",
+                 help = "Number of threads reading segmentation images ahead "
+                        "of the slice being processed, or 0 to read each image "
+                        "only when it is needed. (DEFAULT = 2)")
+
+    p.add_option("--jobs", dest = "jobs", metavar = "INT",
+                 help = "Number of worker processes that mask and trace slices "
+                        "in parallel. The contours are merged in Z order, so the "
+                        "output is identical to that of a serial run. "
+                        "(DEFAULT = 1)")
+
+    p.add_option("--slab", dest = "slab", metavar = "INT",
+                 help = "Number of slices processed at a time. The masked "
+                        "segmentation of each slab is labeled into organelles "
+                        "on its own, and organelles that continue across slabs "
+                        "are joined through the overlap with the slab before. "
+                        "(DEFAULT = as many as fit in --maxmem)")
+
+    p.add_option("--halo", dest = "halo", metavar = "INT",
+                 help = "Number of slices of the slab before that each slab "
+                        "overlaps with. One slice is enough to join organelles "
+                        "across slabs. (DEFAULT = 1)")
+
+    p.add_option("--maxmem", dest = "maxmem", metavar = "MB",
+                 help = "Limit on the memory used for a slab, in megabytes. The "
+                        "slabs are made thin enough to stay within it, with "
+                        "--slab as their largest size. (DEFAULT = {0}, unless "
+                        "--slab is given)".format(DEFAULT_MAXMEM))
+
+    p.add_option("--cache", dest = "cache", metavar = "PATH",
+                 help = "Directory in which to keep the outputs of each step, "
+                        "by the contents of their inputs and their settings. "
+                        "A rerun with the same cache only repeats the steps "
+                        "whose inputs or settings changed, and an interrupted "
+                        "run resumes after the last step it finished.")
+
     p.add_option("--debug", action = "store_true", dest = "debug",
                  help = "Runs in debug mode. In debug mode, intermediate files "
                         "will not be deleted so that they can be checked for "
                         "validity.")
+
+    scratch.addOptions(p)
      
     (opts, args) = p.parse_args()   
+    scratch.handleSignals()
 
     # Set the arguments
     if len(args) != 3:
@@ -72,7 +195,7 @@ if __name__ == "__main__":
     # Set the options
     imodautoR = 0
     if opts.pointreduction:
-        imodautoR = opts.pointreduction
+        imodautoR = float(opts.pointreduction)
 
     imodmeshP = 0
     if opts.passes:
@@ -80,7 +203,29 @@ if __name__ == "__main__":
 
     rmbycont = 2
     if opts.rmbycont:
-        rmbycont = opts.rmbycont
+        rmbycont = int(opts.rmbycont)
+
+    rmbyvoxel = 0
+    if opts.rmbyvoxel:
+        rmbyvoxel = int(opts.rmbyvoxel)
+
+    color = None
+    if opts.color:
+        color = tuple(float(c) for c in opts.color.split(","))
+        if len(color) != 3:
+            usage("The option --color must be given as R,G,B.")
+
+    threads = 2
+    if opts.threads:
+        threads = int(opts.threads)
+        if threads < 0:
+            usage("The option --threads must not be negative.")
+
+    jobs = 1
+    if opts.jobs:
+        jobs = int(opts.jobs)
+        if jobs < 1:
+            usage("The option --jobs must be at least 1.")
 
     # Set and check the output directory
     if opts.path_out:
@@ -96,149 +241,227 @@ if __name__ == "__main__":
     if not os.path.isfile(file_mod):
         usage("The model file {0} does not exist.".format(file_mod))
 
-    # Create temporary directory in the output path
-    path_tmp = os.path.join(path_out, "tmp")
-    if os.path.isdir(path_tmp):
-        usage("There is already a folder with the name tmp in the output "
-              "path {0}".format(path_out))
-    os.makedirs(path_tmp)
+    # Create a scratch workspace for the point file and intermediate models. In
+    # debug mode, it is kept after the run.
+    work = scratch.fromOptions(opts, "mask", opts.debug)
 
-    # Get number of slices in MRC file
-    cmd = "header -size {0}".format(file_mrc)
-    nslices = Popen(cmd.split(), stdout = PIPE)
-    nslices = nslices.stdout.read().split()
-    nColMrc = int(nslices[0])
-    nRowMrc = int(nslices[1])
-    nslices = int(nslices[2])
-
-    # Get list of all segmented organelle files
-    filesOrg = sorted(glob.glob(os.path.join(path_seg, "*")))
-
-    # Loop
-    C = 0
-    for i in range(0, nslices):
-        file_tmp = os.path.join(path_tmp, "tmp" + str(i).zfill(4))
-        cmd = "imodmop -mask 1 -zminmax {0},{0} {1} {2} {3}".format(i, 
-              file_mod, file_mrc, file_tmp + ".mrc")
-        call(cmd.split())
-        cmd = "mrc2tif {0} {1}".format(file_tmp + ".mrc", file_tmp + ".tif")
-        call(cmd.split())
-
-        if not opts.debug:
-            os.remove(file_tmp + ".mrc")
-
-        # Read cell and organelle segmentation images. Resize the cell image
-        # to be the same as the organelle image, which is typically larger
-        imgOrg = misc.imread(filesOrg[i])
-        imgOrg = misc.imresize(imgOrg, [nRowMrc, nColMrc])
-        
-        imgCell = misc.imread(file_tmp + ".tif")
-        imgCell = misc.imresize(imgCell, [nRowMrc, nColMrc])
-
-        # Check image type. If either of the images are empty (all zeros), then
-        # continue to the next iteration of the for loop.
-        unique_org = np.unique(imgOrg)
-        unique_cell = np.unique(imgCell)
-
-        if (unique_cell.size == 1) and (unique_cell[0] == 0):
-            continue
-
-        if (unique_org.size > 2) or (unique_org[0] != 0):
-            usage("Segmentation image is not binary.") 
- 
-        if (unique_cell.size > 2) or (unique_cell[0] != 0):
-            usage("Mask image is not binary.")
-
-        # Check that pixel values are [0, 1]. If not, normalize the image.
-        max_pix_val_org = max(np.unique(imgOrg))
-        max_pix_val_cell = max(np.unique(imgCell))
-        
-        if not (max_pix_val_org == 1):
-            print "Normalizing organelle image."
-            imgOrg = np.divide(imgOrg, max_pix_val_org)
-
-        max_pix_val_cell = max(np.unique(imgCell))
-        if not (max_pix_val_cell == 1):
-            print "Normalizing mask image."
-            imgCell = np.divide(imgCell, max_pix_val_cell)
-
-        # If opts.invert is not input, then mask the image by taking the AND
-        # of the two images to produce only the organelles that lie inside
-        # of the mask. Otherwise, keep only the objects that are outside of
-        # the mask.   
-        if opts.invert:
-            imgMask = np.greater(imgOrg, imgCell)
+    # Keep the outputs of the steps of the run in the cache, or else in the scratch
+    # workspace for this run only
+    try:
+        if opts.cache:
+            pipe = pipeline.Pipeline(opts.cache)
         else:
-            imgMask = np.logical_and(imgCell, imgOrg)
-
-        imgMask.astype("uint8")
-        misc.imsave(file_tmp + ".tif", imgMask)
-
-        # Run imodauto
-        cmd = "imodauto -E 255 -u -R {0} {1} {2}".format(imodautoR,
-              file_tmp + ".tif", file_tmp + ".mod")
-        call(cmd.split())
-
-        cmd = "imodtrans -tz {0} {1} {1}".format(i, file_tmp + ".mod")
-        call(cmd.split())
-        cmd = "model2point -object {0} {1}".format(file_tmp + ".mod",
-              file_tmp + ".txt")
-        call(cmd.split())
-    
-        os.remove(file_tmp + ".mod~")    
-        if not opts.debug: 
-            os.remove(file_tmp + ".mod")
-
-        file_out = os.path.join(path_tmp, "out")        
-        if not os.stat(file_tmp + ".txt").st_size == 0:
-            with open(file_tmp + ".txt") as handle:
-                lastline = (list(handle)[-1])
-            handle.close()
-            ncont = int(lastline.split()[1])
-            with open(file_out + ".txt", "a+") as outfile:
-                with open(file_tmp + ".txt", "r+") as infile:
-                    for line in infile:
-                        lsplit = line.split()
-                        newline = "1 {0} {1} {2} {3}\n".format(int(lsplit[1]) + C,
-                                  lsplit[2], lsplit[3], lsplit[4])
-                        outfile.write(newline)
-                #sys.stdout.write(newline)
-            C = C + ncont
-
-        if not opts.debug:
-            os.remove(file_tmp + ".txt")
-        
-    # Post-processing
-    edmodcmd = "edmod.py --rmbycont {0} ".format(rmbycont)
-    if opts.color:
-        edmodcmd = edmodcmd + "--colorout {0} ".format(opts.color)
-    if opts.name:
-        edmodcmd = edmodcmd + "--nameout {0} ".format(opts.name)
-    edmodcmd = edmodcmd + "{0} {0}".format(file_out + "_sort.mod")  
-
-    cmd = "point2model -image {0} {1} {2}".format(file_mrc, file_out + ".txt",
-          file_out + ".mod")
-    call(cmd.split())
-
-    cmd = "imodmesh -CTs -P {0} {1} {1}".format(imodmeshP, file_out + ".mod")
-    call(cmd.split())
-
-    cmd = "imodsortsurf -s {0} {0}".format(file_out + ".mod", file_out + "_sort.mod")
-    call(cmd.split())
-
-    call(edmodcmd.split())
+            pipe = pipeline.Pipeline(os.path.join(work.disk(), "steps"))
+    except pipeline.PipelineError as e:
+        usage(str(e))
 
-    cmd = "imodmesh -e {0} {0}".format(file_out + "_sort.mod")
-    call(cmd.split())
-
-    cmd = "imodmesh -CTs -P {0} {1} {1}".format(imodmeshP, file_out + "_sort.mod")
-    call(cmd.split())
-
-    cmd = "imodfillin -e {0} {0}".format(file_out + "_sort.mod")
-    call(cmd.split())
-
-    cmd = "imodmesh -e {0} {0}".format(file_out + "_sort.mod")
-    call(cmd.split())
-
-    cmd = "imodmesh -CT {0} {0}".format(file_out + "_sort.mod")
-    call(cmd.split())  
+    # Get number of slices in MRC file
+    try:
+        mrc = mrcio.readHeader(file_mrc)
+    except mrcio.MrcError as e:
+        usage(str(e))
+    nColMrc, nRowMrc, nslices = mrc.size
+
+    # Set the size of the slabs, and make them thin enough to fit in the memory
+    # limit along with their halos. Without either option, the slabs are as thick
+    # as the default limit allows, but at least as thick as their halos.
+    depth = nslices
+    if opts.slab:
+        depth = int(opts.slab)
+        if depth < 1:
+            usage("The option --slab must be at least 1.")
+    halo = 1
+    if opts.halo:
+        halo = int(opts.halo)
+        if halo < 1:
+            usage("The option --halo must be at least 1.")
+    if opts.maxmem:
+        fit = int(float(opts.maxmem) * 1024 * 1024 //
+                  (VOXEL_BYTES * nRowMrc * nColMrc)) - halo
+        if fit < 1:
+            usage("The memory limit of --maxmem is too small for a slab of one "
+                  "slice and its halo.")
+        depth = min(depth, fit)
+    elif not opts.slab:
+        fit = int(DEFAULT_MAXMEM * 1024 * 1024 //
+                  (VOXEL_BYTES * nRowMrc * nColMrc)) - halo
+        depth = min(depth, max(fit, halo))
+    if halo > depth:
+        usage("The halo must not be larger than the slabs, of {0} "
+              "slices.".format(depth))
+
+    # Trace the organelles into a point file. This is the costly step, which is
+    # taken from the cache when the mask model, the segmentation and the settings
+    # that change the contours are the same as in an earlier run.
+    outputs = ["out.txt"]
+    if opts.maskout:
+        outputs.append(os.path.abspath(opts.maskout))
+    params = [hashlib.sha1(mrc.header.tobytes()).hexdigest(), bool(opts.invert),
+              imodautoR, opts.resize, rmbycont, rmbyvoxel, outputs[1:]]
+    step = pipe.step("trace", [file_mod, path_seg], params, outputs)
+    if step.needed():
+        try:
+            file_txt = step.path("out.txt")
+
+            # Rasterize the closed contours of the mask model in-process, slice
+            # by slice, instead of making an image of every slice with imodmop
+            # and mrc2tif
+            try:
+                mask = imodmask.readMask(file_mod, (nColMrc, nRowMrc, nslices))
+            except imodmodel.ImodError as e:
+                usage(str(e))
+
+            # Open the organelle segmentation, either a directory of images, one
+            # per slice, or a multi-page TIFF or MRC stack
+            try:
+                segOrg = segstack.SegmentationStack(path_seg)
+            except segstack.SegError as e:
+                usage(str(e))
+            if len(segOrg) < nslices:
+                usage("The segmentation {0} has fewer slices than the MRC "
+                      "file.".format(path_seg))
+
+            # Create the MRC file for the masked segmentation, which is written
+            # in place slice by slice. Slices that are skipped are left empty.
+            maskOut = None
+            if opts.maskout:
+                maskOut = mrcio.createStack(opts.maskout, mrc.size, np.uint8,
+                                            like = mrc)
+
+            # Loop over the slabs, and the slices with a mask in each. Serially,
+            # their segmentation images are read ahead on a pool of threads; with
+            # --jobs, each worker process reads the images of the slices it is
+            # given. Images are checked to be binary and resized to the size of
+            # the MRC stack. Results come back in Z order, so that contours are
+            # numbered as in a serial run.
+            worker.update(mask = mask, seg = segOrg, shape = (nRowMrc, nColMrc),
+                          resize = opts.resize, invert = opts.invert,
+                          tol = imodautoR)
+            indices = [i for i in mask.slices() if 0 <= i < nslices]
+            pool = None
+            if jobs > 1:
+                pool = Pool(jobs)
+            contours = imodmask.ContourAccumulator()
+            labeler = imodmask.SlabLabeler()
+            contLabels = []
+            prevMask = None
+            prevLabels = None
+            for start in range(0, nslices, depth):
+                stop = min(start + depth, nslices)
+                if depth < nslices:
+                    print "Processing slices {0} to {1}.".format(start, stop - 1)
+
+                # Hold the masked segmentation of the slab, after the halo of the
+                # slab before
+                h = min(halo, start)
+                slab = np.zeros((h + stop - start, nRowMrc, nColMrc), bool)
+                if h:
+                    slab[:h] = prevMask
+                slabIndices = [i for i in indices if start <= i < stop]
+                results = sliceResults(slabIndices, pool, jobs, threads)
+                firstCont = contours.ncont
+                for n in range(len(slabIndices)):
+                    try:
+                        i, traced, imgMask = next(results)
+                    except segstack.SegError as e:
+                        usage(str(e))
+                    if imgMask is not None:
+                        slab[h + i - start] = imgMask
+                        if maskOut is not None:
+                            maskOut.write(i, imgMask)
+                    contours.add(i, traced)
+
+                # Label the organelles of the slab as the 3D connected components
+                # of the masked segmentation, and find the organelle of each of
+                # its contours
+                labels = labeler.label(slab, h, prevLabels)
+                z, first = contours.firstPoints(firstCont)
+                contLabels.append(imodmask.contourLabels(labels, z - start + h,
+                                                         first))
+                prevMask = slab[-halo:].copy()
+                prevLabels = labels[-halo:].copy()
+                del slab, labels
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+            if maskOut is not None:
+                maskOut.close()
+                print "Masked segmentation written to {0}".format(opts.maskout)
+
+            # Join the organelles of all slabs. Organelles with too few contours
+            # or voxels are removed, and the rest numbered as objects in order.
+            components, nvoxels = labeler.resolve()
+            contLabels = components[np.concatenate(contLabels)]
+            nlabels = len(nvoxels) - 1
+            ncont = np.bincount(contLabels, minlength = nlabels + 1)
+            keep = (ncont > rmbycont) & (nvoxels >= rmbyvoxel)
+            keep[0] = False
+            objects = np.cumsum(keep) * keep
+            nobj = int(keep.sum())
+            print "{0} contours with {1} points traced, in {2} organelles, of " \
+                  "which {3} are kept.".format(contours.ncont, contours.npoints,
+                                               nlabels, nobj)
+            if nobj == 0:
+                print "No organelles to write."
+                exit(1)
+
+            # Write the contours of all organelles to a single point file, one
+            # object per organelle
+            contours.write(file_txt, objects[contLabels])
+            step.finish()
+        finally:
+            step.abort()
+    file_txt = step.path("out.txt")
+
+    # Convert the point file to a model
+    step = pipe.step("model", [file_txt], params[:1], ["out.mod"])
+    if step.needed():
+        try:
+            cmd = "point2model -image {0} {1} {2}".format(file_mrc, file_txt,
+                  step.path("out.mod"))
+            if call(cmd.split()) != 0:
+                usage("point2model failed.")
+            step.finish()
+        finally:
+            step.abort()
+    file_in = step.path("out.mod")
+
+    # Post-processing, each command on a copy of the model of the step before
+    commands = [("mesh", "imodmesh -CTs -P {0}".format(imodmeshP)),
+                ("fillin", "imodfillin -e"),
+                ("unmesh", "imodmesh -e"),
+                ("remesh", "imodmesh -CT")]
+    for name, cmd in commands:
+        step = pipe.step(name, [file_in], [cmd], ["out.mod"])
+        if step.needed():
+            try:
+                runModelCommand(cmd, file_in, step.path("out.mod"))
+                step.finish()
+            finally:
+                step.abort()
+        file_in = step.path("out.mod")
+
+    # Set the names and colors of the objects last, so that changing them only
+    # repeats this step
+    if color is not None or opts.name:
+        step = pipe.step("properties", [file_in], [color, opts.name], ["out.mod"])
+        if step.needed():
+            try:
+                model = imodmodel.readModel(file_in)
+                for obj in model.objects:
+                    if color is not None:
+                        obj.color = color
+                    if opts.name:
+                        obj.name = opts.name
+                imodmodel.writeModel(model, step.path("out.mod"))
+                step.finish()
+            finally:
+                step.abort()
+        file_in = step.path("out.mod")
+
+    # Copy the final model to the output path
+    shutil.copyfile(file_in, os.path.join(path_out, "out_sort.mod"))
+    print "Time taken by each step:"
+    pipe.report()
+    work.cleanup()
@@ -0,0 +1,259 @@
+"""
+Reading of MRC image stack headers. The 1024-byte header and the extended
+header that follows it are read in-process with NumPy, in the byte order given
+by the machine stamp, and kept per file path and modification time, so that
+repeated queries of the same stack cost nothing.
+
+The image data of a stack can be opened as a numpy.memmap of (sections, rows,
+columns), which the operating system pages in as slices are accessed, so that
+stacks larger than memory can be read slice by slice without copies. New
+stacks are created at their full size and written in place, slice by slice.
+"""
+
+import os
+import numpy as np
+
+HEADER_SIZE = 1024
+
+# Standard MRC header, with the fields IMOD uses in the extra space
+HEADER = np.dtype([
+    ("nx", "i4"), ("ny", "i4"), ("nz", "i4"), ("mode", "i4"),
+    ("nxstart", "i4"), ("nystart", "i4"), ("nzstart", "i4"),
+    ("mx", "i4"), ("my", "i4"), ("mz", "i4"),
+    ("xlen", "f4"), ("ylen", "f4"), ("zlen", "f4"),
+    ("alpha", "f4"), ("beta", "f4"), ("gamma", "f4"),
+    ("mapc", "i4"), ("mapr", "i4"), ("maps", "i4"),
+    ("amin", "f4"), ("amax", "f4"), ("amean", "f4"),
+    ("ispg", "i4"), ("next", "i4"), ("creatid", "i2"), ("blank1", "V30"),
+    ("nint", "i2"), ("nreal", "i2"), ("blank2", "V20"),
+    ("imodStamp", "i4"), ("imodFlags", "i4"), ("idtype", "i2"), ("lens", "i2"),
+    ("nd1", "i2"), ("nd2", "i2"), ("vd1", "i2"), ("vd2", "i2"),
+    ("tiltangles", "f4", (6,)), ("xorg", "f4"), ("yorg", "f4"), ("zorg", "f4"),
+    ("cmap", "S4"), ("stamp", "u1", (4,)), ("rms", "f4"), ("nlabl", "i4"),
+    ("labels", "S80", (10,))])
+
+# Data types of the pixels for each MRC mode. Mode 0 is unsigned unless the
+# IMOD flags say otherwise.
+MODES = {0: "u1", 1: "i2", 2: "f4", 3: "i2", 4: "c8", 6: "u2", 12: "f2"}
+MODE_NAMES = {0: "byte", 1: "short", 2: "float", 3: "complex short",
+              4: "complex float", 6: "unsigned short", 12: "half float"}
+
+IMOD_STAMP = 1146047817
+IMODFLAG_SIGNED = 1
+
+# Machine stamp of little-endian files
+STAMP_LITTLE = (0x44, 0x44, 0, 0)
+
+class MrcError(Exception):
+    pass
+
+# Headers read so far, by path, with the modification time and size they were
+# read at
+cache = {}
+
+# The header of an MRC stack. header is a one-element structured array in the
+# byte order of the file, and extended holds the raw bytes of the extended
+# header.
+class MrcHeader(object):
+    def __init__(self, header, extended = b""):
+        self.header = header
+        self.extended = extended
+
+    def field(self, name):
+        return self.header[name][0]
+
+    # Number of columns, rows and sections
+    @property
+    def size(self):
+        return tuple(int(self.field(n)) for n in ("nx", "ny", "nz"))
+
+    @property
+    def mode(self):
+        return int(self.field("mode"))
+
+    @property
+    def byteorder(self):
+        return self.header.dtype.fields["nx"][0].byteorder
+
+    # Data type of the pixels, in the byte order of the file
+    @property
+    def dtype(self):
+        mode = self.mode
+        if mode not in MODES:
+            raise MrcError("Unsupported MRC mode {0}".format(mode))
+        dtype = MODES[mode]
+        if mode == 0 and (self.field("imodStamp") == IMOD_STAMP and
+                          self.field("imodFlags") & IMODFLAG_SIGNED):
+            dtype = "i1"
+        if mode == 3:
+            return np.dtype([("real", self.byteorder + "i2"),
+                             ("imag", self.byteorder + "i2")])
+        return np.dtype(dtype).newbyteorder(self.byteorder)
+
+    # Pixel spacing in X, Y and Z, the cell size divided by the sampling. A
+    # sampling of 0 is taken as 1.
+    @property
+    def pixel(self):
+        return tuple(float(self.field(length)) / (int(self.field(m)) or 1)
+                     for length, m in (("xlen", "mx"), ("ylen", "my"), ("zlen", "mz")))
+
+    @property
+    def origin(self):
+        return tuple(float(self.field(n)) for n in ("xorg", "yorg", "zorg"))
+
+    # Byte offset of the image data in the file
+    @property
+    def dataOffset(self):
+        return HEADER_SIZE + int(self.field("next"))
+
+# Find the byte order of a raw header. The machine stamp gives it for files
+# written by current programs; for older files with no stamp, the order in which
+# the mode and dimensions are plausible is taken.
+def byteOrder(raw):
+    stamp = bytearray(raw[212:214])
+    if stamp[0] in (0x44, 0x41) and stamp[1] in (0x44, 0x41):
+        return "<"
+    if stamp[0] == 0x11 and stamp[1] == 0x11:
+        return ">"
+    for order in ("<", ">"):
+        head = np.frombuffer(raw[:16], order + "i4")
+        if 0 <= head[3] <= 16 and (head[:3] > 0).all() and (head[:3] < 1 << 24).all():
+            return order
+    raise MrcError("Cannot determine the byte order of the MRC header")
+
+# Read the header of an MRC file, or return the one read before if the file has
+# not changed since
+def readHeader(file_mrc):
+    path = os.path.abspath(file_mrc)
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size)
+    if path in cache and cache[path][0] == key:
+        return cache[path][1]
+    with open(path, "rb") as fid:
+        raw = fid.read(HEADER_SIZE)
+        if len(raw) != HEADER_SIZE:
+            raise MrcError("{0} is too short to be an MRC file".format(file_mrc))
+        dtype = HEADER.newbyteorder(byteOrder(raw))
+        header = np.frombuffer(raw, dtype).copy()
+        nextra = int(header["next"][0])
+        if nextra < 0:
+            raise MrcError("Invalid extended header size in {0}".format(file_mrc))
+        extended = fid.read(nextra)
+    mrc = MrcHeader(header, extended)
+    cache[path] = (key, mrc)
+    return mrc
+
+# Return the MRC mode and IMOD flags for writing data of a NumPy type. Booleans
+# are written as bytes.
+def modeOf(dtype):
+    dtype = np.dtype(dtype)
+    if dtype == np.bool_:
+        dtype = np.dtype("u1")
+    if dtype.kind == "i" and dtype.itemsize == 1:
+        return 0, IMODFLAG_SIGNED
+    for mode, code in sorted(MODES.items()):
+        if mode != 3 and np.dtype(code) == dtype.newbyteorder("="):
+            return mode, 0
+    raise MrcError("No MRC mode for data of type {0}".format(dtype))
+
+# An MRC stack whose image data is memory mapped. data is a numpy.memmap of
+# (sections, rows, columns) in the byte order of the file. Stacks opened for
+# writing keep the range and mean of the slices written with write(), which
+# are stored in the header when the stack is closed.
+class MrcStack(object):
+    def __init__(self, file_mrc, header, mode = "r"):
+        self.file_mrc = file_mrc
+        self.header = header
+        ncol, nrow, nsec = header.size
+        self.data = np.memmap(file_mrc, header.dtype, mode, header.dataOffset,
+                              (nsec, nrow, ncol))
+        self.writable = mode != "r"
+        self.amin = None
+        self.amax = None
+        self.total = 0.0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, value, traceback):
+        self.close()
+
+    # Return a slice as a view into the mapped file
+    def slice(self, z):
+        return self.data[z]
+
+    # Write a slice in place, converting it to the data type of the file. The range
+    # and mean are not kept for complex data.
+    def write(self, z, img):
+        if not self.writable:
+            raise MrcError("{0} is not open for writing".format(self.file_mrc))
+        self.data[z] = img
+        img = self.data[z]
+        if img.dtype.names or img.dtype.kind == "c":
+            return
+        lo = float(img.min())
+        hi = float(img.max())
+        self.amin = lo if self.amin is None else min(self.amin, lo)
+        self.amax = hi if self.amax is None else max(self.amax, hi)
+        self.total = self.total + float(img.sum(dtype = np.float64))
+
+    # Flush the data and, for a stack being written, store the range and mean of
+    # the slices written in the header
+    def close(self):
+        if self.data is None:
+            return
+        if self.writable:
+            self.data.flush()
+            if self.amin is not None:
+                header = self.header.header
+                header["amin"] = self.amin
+                header["amax"] = self.amax
+                header["amean"] = self.total / max(self.data.size, 1)
+                with open(self.file_mrc, "r+b") as fid:
+                    fid.write(header.tobytes())
+            cache.pop(os.path.abspath(self.file_mrc), None)
+        self.data = None
+
+# Open the image data of an MRC file as an MrcStack. mode is "r" to read, or "r+"
+# to also write the slices in place.
+def openStack(file_mrc, mode = "r"):
+    header = readHeader(file_mrc)
+    needed = header.dataOffset + int(np.prod(header.size)) * header.dtype.itemsize
+    if os.path.getsize(file_mrc) < needed:
+        raise MrcError("{0} is shorter than its header says".format(file_mrc))
+    return MrcStack(file_mrc, header, mode)
+
+# Create a little-endian MRC file for a stack of size (columns, rows, sections) of
+# data of a NumPy type, and return it as an MrcStack open for writing. The file is
+# created at its full size, without writing the data, and pixel and origin give
+# the pixel spacing and origin. The header of another stack may be given as like,
+# whose pixel spacing and origin are then used.
+def createStack(file_mrc, size, dtype, pixel = (1.0, 1.0, 1.0),
+                origin = (0.0, 0.0, 0.0), like = None):
+    if like is not None:
+        pixel = like.pixel
+        origin = like.origin
+    mode, flags = modeOf(dtype)
+    header = np.zeros(1, HEADER.newbyteorder("<"))
+    for n, name in enumerate(("x", "y", "z")):
+        header["n" + name] = size[n]
+        header["m" + name] = size[n]
+        header[name + "len"] = size[n] * pixel[n]
+        header[name + "org"] = origin[n]
+        header["map" + "crs"[n]] = n + 1
+    header["mode"] = mode
+    header["alpha"] = header["beta"] = header["gamma"] = 90
+    header["imodStamp"] = IMOD_STAMP
+    header["imodFlags"] = flags
+    header["cmap"] = b"MAP "
+    header["stamp"] = STAMP_LITTLE
+    header["nlabl"] = 1
+    header["labels"][0, 0] = b"Written by mrcio".ljust(80)
+    mrc = MrcHeader(header)
+    with open(file_mrc, "wb") as fid:
+        fid.write(header.tobytes())
+        fid.truncate(mrc.dataOffset + int(np.prod(size)) * mrc.dtype.itemsize)
+    return MrcStack(file_mrc, mrc, "r+")
@@ -0,0 +1,179 @@
+"""
+Cached pipelines of steps. Each step of a pipeline writes its output files to a
+directory of a cache, named after a key hashed from the step's name, its
+parameters and the contents of its input files. A step whose key is already in
+the cache is not run again, so that a rerun only repeats the steps whose inputs
+or parameters changed, and the steps after them whose inputs then change in
+turn. Steps are written to a private directory that is renamed into place once
+they finish, so that a step interrupted part way is run again from scratch,
+while the steps completed before it are reused.
+
+Input files are hashed by their contents. The hashes are kept in the cache by
+path, size and modification time, so that large inputs are only read again
+when they change.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+# Bytes read at a time when hashing files
+CHUNK_SIZE = 1 << 20
+
+# File of a step's directory recording that it finished
+RECORD = "step.json"
+
+# File of the cache holding the hashes of input files
+FINGERPRINTS = "fingerprints.json"
+
+class PipelineError(Exception):
+    pass
+
+# Return the SHA-1 digest of the contents of a file
+def hashFile(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fid:
+        block = fid.read(CHUNK_SIZE)
+        while block:
+            digest.update(block)
+            block = fid.read(CHUNK_SIZE)
+    return digest.hexdigest()
+
+# Write an object as JSON to a file, through a temporary file renamed over it so
+# that the file is never left half written
+def writeJson(obj, path):
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path))
+    with os.fdopen(fd, "w") as fid:
+        json.dump(obj, fid, indent = 1, sort_keys = True)
+    os.rename(tmp, path)
+
+# A cache of step outputs in the directory path, which is created if needed.
+# times holds the name of each step met so far with the seconds it took to run,
+# or None if it was taken from the cache.
+class Pipeline(object):
+    def __init__(self, path):
+        self.path = path
+        self.times = []
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                raise PipelineError("Cannot create the cache {0}: {1}".format(path, e))
+        self.fingerprints = {}
+        file_fp = os.path.join(path, FINGERPRINTS)
+        if os.path.isfile(file_fp):
+            try:
+                with open(file_fp) as fid:
+                    self.fingerprints = json.load(fid)
+            except ValueError:
+                pass
+
+    # Return the hash of the contents of a file, or of the names and contents of
+    # the files of a directory
+    def hash(self, path):
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            digest = hashlib.sha1()
+            for name in sorted(os.listdir(path)):
+                digest.update(name)
+                digest.update(self.hash(os.path.join(path, name)))
+            return digest.hexdigest()
+        if not os.path.isfile(path):
+            raise PipelineError("The input {0} does not exist.".format(path))
+        stat = os.stat(path)
+        known = self.fingerprints.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime]:
+            return str(known[2])
+        sha = hashFile(path)
+        self.fingerprints[path] = [stat.st_size, stat.st_mtime, sha]
+        writeJson(self.fingerprints, os.path.join(self.path, FINGERPRINTS))
+        return sha
+
+    # Return the step name, reading the files of inputs and producing the files
+    # named in outputs, with the parameters params, which must be JSON values
+    def step(self, name, inputs = (), params = (), outputs = ()):
+        return Step(self, name, inputs, params, outputs)
+
+    # Print the time taken by each step
+    def report(self):
+        total = 0.0
+        for name, seconds in self.times:
+            if seconds is None:
+                print "  {0:<12} cached".format(name)
+            else:
+                print "  {0:<12} {1:10.1f} s".format(name, seconds)
+                total = total + seconds
+        print "  {0:<12} {1:10.1f} s".format("total", total)
+
+# A step of a pipeline. outputs are the names of files in the directory of the
+# step, or absolute paths of files it writes elsewhere, which must also exist for
+# the step to be taken from the cache. A step is run by writing its outputs to the
+# paths given by path() when needed() returns True, and then calling finish().
+# abort() should follow in any case, so that a step that fails or exits part way
+# leaves nothing behind in the cache.
+class Step(object):
+    def __init__(self, pipe, name, inputs, params, outputs):
+        self.pipe = pipe
+        self.name = name
+        self.outputs = list(outputs)
+        hashes = [pipe.hash(path) for path in inputs]
+        key = hashlib.sha1(json.dumps([name, list(params), hashes])).hexdigest()
+        self.dir = os.path.join(pipe.path, "{0}-{1}".format(name, key[:16]))
+        self.work = None
+        self.start = None
+        self.record = {"name": name, "params": list(params),
+                       "inputs": [[os.path.abspath(path), sha]
+                                  for path, sha in zip(inputs, hashes)]}
+
+    # Return whether the step has finished before with the same inputs and
+    # parameters, and its outputs are still there
+    def cached(self):
+        if not os.path.isfile(os.path.join(self.dir, RECORD)):
+            return False
+        return all(os.path.exists(os.path.join(self.dir, name))
+                   for name in self.outputs)
+
+    # Return the path of an output of the step
+    def path(self, name):
+        return os.path.join(self.work or self.dir, name)
+
+    # Return whether the step has to be run. If it has, its private directory is
+    # created and the step is timed from now on.
+    def needed(self):
+        if self.cached():
+            print "Step {0} taken from the cache.".format(self.name)
+            self.pipe.times.append((self.name, None))
+            return False
+        print "Running step {0}.".format(self.name)
+        self.work = tempfile.mkdtemp(prefix = os.path.basename(self.dir) + ".",
+                                     dir = self.pipe.path)
+        self.start = time.time()
+        return True
+
+    # Record that the step finished, and move its outputs into the cache. If
+    # another run finished the same step meanwhile, its outputs are kept.
+    def finish(self):
+        seconds = time.time() - self.start
+        for name in self.outputs:
+            if not os.path.exists(self.path(name)):
+                raise PipelineError("Step {0} did not write {1}.".format(self.name,
+                                                                       name))
+        self.record["seconds"] = seconds
+        writeJson(self.record, os.path.join(self.work, RECORD))
+        if self.cached():
+            shutil.rmtree(self.work, ignore_errors = True)
+        else:
+            shutil.rmtree(self.dir, ignore_errors = True)
+            os.rename(self.work, self.dir)
+        self.work = None
+        print "Step {0} finished in {1:.1f} s.".format(self.name, seconds)
+        self.pipe.times.append((self.name, seconds))
+
+    # Remove the private directory of a step that was started and did not finish
+    def abort(self):
+        if self.work is not None:
+            shutil.rmtree(self.work, ignore_errors = True)
+            self.work = None
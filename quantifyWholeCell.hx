@@ -1285,31 +1285,39 @@ set opts(renderWholeCell) 1
 # END INPUT PARAMETERS
 #
 #//
-set wrlfiles [lsort [glob -nocomplain -type f $opts(path_in)/*.wrl ]]
+# Surfaces written by quantifyWholeCell.py --surf (*.surf) are loaded directly;
+# VRML files (*.wrl) are converted to surfaces first
+set wrlfiles [lsort [concat [glob -nocomplain -type f $opts(path_in)/*.wrl ] \
+                            [glob -nocomplain -type f $opts(path_in)/*.surf ]]]
 set nwrlfiles [ llength $wrlfiles ]
 
 for {set N 0} {$N < $nwrlfiles} {incr N} {
 
-    # Get basename and load file
+    # Get basename
     set fname [ lindex $wrlfiles $N ]
     set base [ file tail $fname ]
-    set base [ string trimright $base ".wrl" ]
-    [ load $fname ] setLabel $base
+    set base [ file rootname $base ]
 
     # Get the organelle type based on the filename 
     set orglist [ split $base "_" ]
     set organelle [ lindex $orglist 0 ] 
     set number [ lindex $orglist 1 ] 
-   
-    # Convert VRML to Surface
-    set module [ concat "Open Inventor Scene To Surface" $number ]
-    echo $module
-    echo $base
-    create HxGeometryToSurface $module
-    $module data connect $base
-    $module action snap
-    $module fire
-    "GeometrySurface" setLabel [ appendn "GeometrySurface" $number ]
+
+    if {[file extension $fname] == ".surf"} {
+        # Load the surface as it is
+        [ load $fname ] setLabel [ appendn "GeometrySurface" $number ]
+    } else {
+        # Load the VRML file and convert it to a surface
+        [ load $fname ] setLabel $base
+        set module [ concat "Open Inventor Scene To Surface" $number ]
+        echo $module
+        echo $base
+        create HxGeometryToSurface $module
+        $module data connect $base
+        $module action snap
+        $module fire
+        "GeometrySurface" setLabel [ appendn "GeometrySurface" $number ]
+    }
 
     # Run the appropriate workflow
     set write_header 0 
@@ -10,10 +10,13 @@ import os
 import os.path
 import sys
 import re
-import fileinput
 from sys import argv
 from subprocess import call, check_output, Popen, PIPE
 from optparse import OptionParser
+import imodmodel
+import mrcio
+import scratch
+from imod2amira import convertVrml, writeSurface
 
 # Print erorr messages and exit
 def usage(errstr):
@@ -24,65 +27,32 @@ def usage(errstr):
     print ""
     exit(1)
 
-# Convert IMOD model file to ASCII using imodinfo
-def mod2ascii(mod_in, ascii_out):
-    handle = open(ascii_out, "w+")
-    cmd = "imodinfo -a {0}".format(mod_in)
-    call(cmd.split(), stdout = handle)
-    return handle
-
-# Parse through a text file until the regexp is matched. Once a match occurs,
-# return the entire line and break the loop.
-def matchLine(regexp, handle):
-    for line in handle:
-        if re.match(regexp, line.lstrip()):
-            return line
-            break
-        else:
-            continue
-        break
-
-# Get header info from an input MRC stack
-def getMrcStackInfo(file_mrc, string):
-    cmd = "header -{0} {1}".format(string, file_mrc)
-    headerout = Popen(cmd.split(), stdout = PIPE).communicate()[0]
-    header = headerout.split()
-    return header
-
 def maskSubvolume(file_in, file_out, mrc_in):
     cmd = "imodmop -mask 1 -border 0 {0} {1} {2}".format(file_in + ".mod",
            mrc_in, file_out + ".mrc")
     call(cmd.split())
 
+# Convert a model file to VRML with imod2vrml2, and scale its points to match the
+# MRC stack. Unlike imod2amira.py, Z is not divided by the model's Z scale.
 def imod2amira(file_mod, file_wrl, scale, origin):
-    cmd = "imod2vrml2 {0} {1}".format(file_mod, file_wrl)
-    call(cmd.split())
-    handle = open(file_wrl, "r+")
-    coordswitch = 0
-    for line in fileinput.input(file_wrl, inplace = True):
-        if re.match("^point", line.lstrip()):
-            coordswitch = 1
-            sys.stdout.write(line)
-            continue
-        if re.match("\]", line.lstrip()):
-            coordswitch = 0
-            sys.stdout.write(line)
-            continue
-        if coordswitch:
-            lineafter = line.lstrip()
-            lenbefore = len(line)
-            lenafter = len(lineafter)
-            nspaces = lenbefore - lenafter
-            blankspace = " " * nspaces
-            coordx = float(lineafter.split()[0]) * float(scale[0]) + float(origin[0])
-            coordy = float(lineafter.split()[1]) * float(scale[1]) + float(origin[1])
-            coordz = lineafter.split()[2]
-            coordz = float(coordz.split(",")[0]) * float(scale[2]) + float(origin[2])
-            line = "%s%0.1f %0.1f %0.1f,\n" % (blankspace, coordx, coordy, coordz)
-            sys.stdout.write(line)
-        else:
-            sys.stdout.write(line)
-    handle.close()
+    convertVrml(file_mod, file_wrl, [float(v) for v in scale], origin)
+
+# Export object i of the model to fname. The object is written to the model file
+# file_mod and converted to VRML, or, with surf, its meshes are written directly
+# to an Amira surface file. Surfaces are scaled the same as the VRML files, whose
+# Z values imod2vrml2 has already multiplied by the model's Z scale. Returns the
+# name of the file written.
+def exportObject(model, i, file_mod, fname, scale, origin, surf):
+    sub = imodmodel.subModel(model, [i])
+    if surf:
+        zscale = float(model.header["zscale"][0])
+        scale = [float(scale[0]), float(scale[1]), float(scale[2]) * zscale]
+        writeSurface(sub, fname + ".surf", scale, origin)
+        return fname + ".surf"
+    imodmodel.writeModel(sub, file_mod)
+    imod2amira(file_mod, fname + ".wrl", scale, origin)
+    os.remove(file_mod)
+    return fname + ".wrl"
 
 def get_imodinfo(file_mod, vsa):
     vsa_ascii_i = open(file_mod + ".txt", "w+")
@@ -120,7 +90,14 @@ if __name__ == "__main__":
     p.add_option("--output", dest = "path_out", metavar = "PATH",
                  help = "Output path.")
 
+    p.add_option("--surf", action = "store_true", dest = "surf",
+                 help = "Write each object's meshes directly to a binary Amira "
+                        "surface (.surf) file instead of converting it to VRML.")
+
+    scratch.addOptions(p)
+
     (opts, args) = p.parse_args()
+    scratch.handleSignals()
 
     # Check the validity of the input arguments
     if len(args) is not 2:
@@ -139,77 +116,71 @@ if __name__ == "__main__":
     if not os.path.isdir(path_out):
         usage("The output path {0} does not exist".format(path_out)) 
 
+    # Read the header of the MRC stack
+    try:
+        mrc = mrcio.readHeader(mrc_in)
+    except mrcio.MrcError as e:
+        usage(str(e))
+
     # Get scale info from mrc stack if not specified by user
     if opts.scalein:
         scale = opts.scalein.split(",")
     else:
-        scale = getMrcStackInfo(mrc_in, "pixel")
+        scale = mrc.pixel
     print scale
 
     # Get origin info from mrc stack
-    origin = getMrcStackInfo(mrc_in, "origin")
+    origin = mrc.origin
 
-    # Create temporary directory in the output path
+    # Create the directory for the VRML files in the output path, and a scratch
+    # workspace for the intermediate files
     mod_base = os.path.basename(os.path.splitext(mod_in)[0])
     path_tmp = os.path.join(path_out, mod_base)
-    os.makedirs(path_tmp)
+    if not os.path.isdir(path_tmp):
+        os.makedirs(path_tmp)
     print path_tmp
+    work = scratch.fromOptions(opts, mod_base)
 
     # Parse model file for global model values
-    asciifile = os.path.join(path_tmp, mod_base + ".txt")
-    fid = mod2ascii(mod_in, asciifile)
-    fid.seek(0)
-    line = matchLine("^imod", fid)
-    nobj = int(line.split()[1])
-    line = matchLine("^scale", fid)
-    zscale = float(line.split()[3])
-    line = matchLine("^pixsize", fid)
-    lat_pix_size = float(line.split()[1])
-    line = matchLine("^units", fid)
-    units = line.split()[1]
+    model = imodmodel.readModel(mod_in)
+    nobj = len(model.objects)
+    zscale = float(model.header["zscale"][0])
+    lat_pix_size = float(model.header["pixsize"][0])
+    units = model.units
     if not units == "nm":
         usage("The units in the model's header must be given in nm/pixel.")
     axl_pix_size = int(round(zscale * lat_pix_size))
-    fid.close()
-    os.remove(os.path.join(asciifile))
 
     # Parse each object in the model file
     for i in range(0, nobj):
-	file_i = os.path.join(path_tmp, str(i+1).zfill(4))
-        cmd = "imodextract {0} {1} {2}".format(i+1, mod_in, file_i + ".mod")
-        call(cmd.split())
-        handle = mod2ascii(file_i + ".mod", file_i + ".txt")
-        handle.seek(0)
-        line = matchLine("^name", handle)
-        name = line[5:].rstrip().lower()
-        handle.close()
-        os.remove(file_i + ".txt")
+	file_i = work.path(str(i+1).zfill(4), 12 * model.objects[i].npoints())
+        name = model.objects[i].name.rstrip().lower()
 	if (name == "mitochondrion") or (name == "mitochondria") or (name == "mito"):
             feature = "mitochondrion"
             fname = os.path.join(path_tmp, feature + "_" + str(i+1).zfill(4))
-            imod2amira(file_i + ".mod", fname + ".wrl", scale, origin)
-            os.remove(file_i + ".mod")
+            file_out = exportObject(model, i, file_i + ".mod", fname, scale, origin,
+                                    opts.surf)
             #xcent, ycent, zcent, vol, sa, svr = get_imodinfo(file_i, 1)
 	    #print "%d,%s,%f,%f,%f,%f,%f,%f" %(i+1, feature, xcent, ycent, zcent, vol, sa, svr )
 	elif (name == "nucleus") or (name == "nuclei"):
 	    feature = "nucleus"
             fname = os.path.join(path_tmp, feature + "_" + str(i+1).zfill(4))
-            imod2amira(file_i + ".mod", fname + ".wrl", scale, origin)
-            os.remove(file_i + ".mod")
+            file_out = exportObject(model, i, file_i + ".mod", fname, scale, origin,
+                                    opts.surf)
             #xcent, ycent, zcent, vol, sa, svr = get_imodinfo(file_i, 1)
             #print "%d,%s,%f,%f,%f,%f,%f,%f" %(i+1, feature, xcent, ycent, zcent, vol, sa, svr )
 	elif (name == "nucleolus") or (name == "nucleoli"):
 	    feature = "nucleolus"
             fname = os.path.join(path_tmp, feature + "_" + str(i+1).zfill(4))
-            imod2amira(file_i + ".mod", fname + ".wrl", scale, origin)
-            os.remove(file_i + ".mod")
+            file_out = exportObject(model, i, file_i + ".mod", fname, scale, origin,
+                                    opts.surf)
             #xcent, ycent, zcent, vol, sa, svr = get_imodinfo(file_i, 1)
 	    #print "%d,%s,%f,%f,%f,%f,%f,%f" %(i+1, feature, xcent, ycent, zcent, vol, sa, svr )
 	elif (name == "lysosome") or (name == "lysosomes"):
 	    feature = "lysosome"
             fname = os.path.join(path_tmp, feature + "_" + str(i+1).zfill(4))
-            imod2amira(file_i + ".mod", fname + ".wrl", scale, origin)
-            os.remove(file_i + ".mod")
+            file_out = exportObject(model, i, file_i + ".mod", fname, scale, origin,
+                                    opts.surf)
             #xcent, ycent, zcent, vol, sa, svr = get_imodinfo(file_i, 1)
 	    #print "%d,%s,%f,%f,%f,%f,%f,%f" %(i+1, feature, xcent, ycent, zcent, vol, sa, svr )
 	elif (name == "centriole"):
@@ -224,29 +195,31 @@ if __name__ == "__main__":
                (name == "stb")):
 	    feature = "stigmoidbody"
             fname = os.path.join(path_tmp, feature + "_" + str(i+1).zfill(4))
-            imod2amira(file_i + ".mod", fname + ".wrl", scale, origin)
-            os.remove(file_i + ".mod")
+            file_out = exportObject(model, i, file_i + ".mod", fname, scale, origin,
+                                    opts.surf)
             #xcent, ycent, zcent, vol, sa, svr = get_imodinfo(file_i, 1)
 	    #print "%d,%s,%f,%f,%f,%f,%f,%f" %(i+1, feature, xcent, ycent, zcent, vol, sa, svr )
 	elif ((name == "primary cilium") or (name == "primary cilia") or 
                (name == "cilia") or (name == "cilium")):
 	    feature = "primarycilium"
             fname = os.path.join(path_tmp, feature + "_" + str(i+1).zfill(4))
-            imod2amira(file_i + ".mod", fname + ".wrl", scale, origin)
-            os.remove(file_i + ".mod")
+            file_out = exportObject(model, i, file_i + ".mod", fname, scale, origin,
+                                    opts.surf)
 	elif ((name == "plasma membrane") or (name == "plasmamembrane") or
                (name == "membrane") or (name == "neuron")):
 	    feature = "plasmamembrane"
             fname = os.path.join(path_tmp, feature + "_" + str(i+1).zfill(4))
-            imod2amira(file_i + ".mod", fname + ".wrl", scale, origin)
-            os.remove(file_i + ".mod")
+            file_out = exportObject(model, i, file_i + ".mod", fname, scale, origin,
+                                    opts.surf)
 	    #print "%d,%s" %(i+1, feature)
         else:
             feature = "unknownfeature"
-        print "{0} written.\n".format(fname + ".wrl")
+        print "{0} written.\n".format(file_out)
 
 	#os.remove(file_i + ".mod")
 
+    work.cleanup()
+
     # Run programs
     #cmd = "/usr/local/apps/Amira-5.6.0/bin/start -no_gui /home/aperez/usr/local/amira/mito_skeleton.hx"
     #subprocess.call(cmd.split())
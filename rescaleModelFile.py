@@ -17,10 +17,11 @@ Maintains object names and colors.
 import os
 import sys
 import re
-import shutil
 from optparse import OptionParser
 from subprocess import Popen, call, PIPE
 from sys import stderr, exit, argv
+import imodmodel
+import scratch
 
 # Print erorr messages and exit
 def usage(errstr):
@@ -31,28 +32,13 @@ def usage(errstr):
     print ""
     exit(1)
 
-# Parse through a text file until the regexp is matched. Once a match occurs,
-# return the entire line and break the loop.
-def matchLine(regexp, fid):
-    for line in fid:
-        if re.match(regexp, line.lstrip()):
-            return line
-            break
-        else:
-            continue
-        break
-
-# Convert IMOD model file to ASCII using imodinfo
-def mod2ascii(mod_in, ascii_out):
-    fid = open(ascii_out, "w+")
-    cmd = "imodinfo -a {0}".format(mod_in)
-    call(cmd.split(), stdout = fid)
-    return fid
-
 if __name__ == "__main__":
     p = OptionParser(usage = "%prog [options] file.mrc file_in.mod file_out.mod")
 
+    scratch.addOptions(p)
+
     (opts, args) = p.parse_args()
+    scratch.handleSignals()
 
     if len(args) is not 3:
         usage("Improper number of arguments. See the usage below.")
@@ -66,8 +52,6 @@ if __name__ == "__main__":
     if not path_out:
         path_out = os.getcwd()
 
-    path_tmp = os.path.join(path_out, "tmp")
-
     # Check validity of positional arguments
     if not os.path.isfile(file_mrc):
         usage("The input file {0} does not exit".format(file_mrc))
@@ -75,46 +59,33 @@ if __name__ == "__main__":
     if not os.path.isfile(file_in):
         usage("The input file {0} does not exist".format(file_in))
 
-    # Create temporary directory in the output path
-    if os.path.isdir(path_tmp):
-        usage("There is already a folder with the name tmp in the output "
-              "path {0}".format(path_out))
-    os.makedirs(path_tmp)
+    # Create a scratch workspace for the intermediate files
+    work = scratch.fromOptions(opts, "rescale")
   
     # Get the number of objects in the whole model file
     print "Determining the number of objects in {0}".format(file_in)
-    asciifile = os.path.join(path_tmp, "ascii.txt")
-    fid = mod2ascii(file_in, asciifile)
-    fid.seek(0)
-    line = matchLine("^imod", fid)
-    nobj = int(line.split()[1])
-    fid.close()
-    os.remove(asciifile)
+    model = imodmodel.readModel(file_in)
+    nobj = len(model.objects)
     print "Objects found: {0}".format(nobj)
     
+    mods = []
     for N in range(0, nobj):
         print "Processing object {0}.".format(N+1)
         base_tmp = "object_" + str(N+1).zfill(6)
-        mod_tmp = os.path.join(path_tmp, base_tmp + ".mod")
-        txt_tmp = os.path.join(path_tmp, base_tmp + ".txt")
 
         # Extract the object to a new model file
-        cmd = "imodextract {0} {1} {2}".format(N+1, file_in, mod_tmp)
-        call(cmd.split())
+        obj = model.objects[N]
+        size = 12 * obj.npoints()
+        mod_tmp = work.path(base_tmp + ".mod", size)
+        txt_tmp = work.path(base_tmp + ".txt", size * 4)
+        imodmodel.writeModel(imodmodel.subModel(model, [N]), mod_tmp)
 
         # Get the object name and object color
-        fid = mod2ascii(mod_tmp, asciifile)
-        fid.seek(0)
-        line = matchLine("^name", fid)
-        name = line.split()[1:]
-        name = " ".join(name)
-        line = matchLine("^color", fid)
-        color = line.split()[1:4]
-        colorR = int(round(float(color[0]) * 255))
-        colorG = int(round(float(color[1]) * 255))
-        colorB = int(round(float(color[2]) * 255))
-        fid.close()
-        os.remove(asciifile)
+        name = " ".join(obj.name.split())
+        color = obj.color
+        colorR = int(round(color[0] * 255))
+        colorG = int(round(color[1] * 255))
+        colorB = int(round(color[2] * 255))
 
         # Convert object to point notation, then back to a model scaled to
         # the desired MRC file
@@ -135,18 +106,13 @@ if __name__ == "__main__":
         call(cmd)
         os.remove(txt_tmp)
 
-        # Join the individual files into the final output model file
-        if N == 0:
-            os.rename(mod_tmp, file_out)
-        else:
-            cmd = "imodjoin {0} {1} {0}".format(file_out, mod_tmp)
-            call(cmd.split())
-            os.remove(mod_tmp)
+        mods.append(mod_tmp)
+
+    # Join the individual files into the final output model file in one pass
+    imodmodel.joinModels(mods, file_out)
 
     # Cleanup
-    if N > 0:
-        os.remove(file_out + "~")
-    shutil.rmtree(path_tmp)
+    work.cleanup()
 
     # Print disclaimer about meshing
     print("SUCCESS! {0} created".format(file_out))
@@ -0,0 +1,147 @@
+"""
+Scratch workspaces for the intermediate files of the amiratools scripts. Each
+run gets its own uniquely named directory, so that several runs can share an
+output path. Intermediate files can be kept in RAM (on /dev/shm) up to a size
+cap, and spill over to a directory on local disk once the cap is reached.
+Workspaces are removed when they are cleaned up, when the script exits, or
+when it is terminated by SIGTERM or SIGHUP, unless they are kept for
+debugging.
+"""
+
+import os
+import sys
+import shutil
+import signal
+import atexit
+import tempfile
+
+# RAM-backed filesystem used for scratch files when --scratch-ram is given
+RAM_DIR = "/dev/shm"
+
+# Environment variable giving the default location of scratch workspaces on disk
+SCRATCH_ENV = "AMIRATOOLS_SCRATCH"
+
+# Workspaces that have not been cleaned up yet
+active = set()
+
+# Add the options controlling scratch workspaces to an OptionParser
+def addOptions(p):
+    p.add_option("--scratch", dest = "scratch", metavar = "PATH",
+                 help = "Path in which to create the scratch directory for "
+                        "intermediate files. (DEFAULT = ${0}, or the system "
+                        "temporary directory)".format(SCRATCH_ENV))
+    p.add_option("--scratch-ram", dest = "scratchram", metavar = "MB",
+                 help = "Keep up to this many megabytes of intermediate files "
+                        "in RAM (on {0}). Files beyond this are written to the "
+                        "scratch path. (DEFAULT = 0)".format(RAM_DIR))
+    p.add_option("--keep-scratch", action = "store_true", dest = "keepscratch",
+                 help = "Do not delete the scratch directory, so that "
+                        "intermediate files can be checked for validity.")
+
+# Create a workspace from the options added by addOptions. keep forces the
+# workspace to be kept, as in a script's debug mode.
+def fromOptions(opts, prefix = "tmp", keep = False):
+    ram = 0
+    if opts.scratchram:
+        ram = int(float(opts.scratchram) * 1024 * 1024)
+    return Workspace(opts.scratch, ram, keep or opts.keepscratch, prefix)
+
+# Return the total size in bytes of the files below a directory
+def diskUsage(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total = total + os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+# A per-run scratch directory. path is the location of the directory on disk,
+# ram the number of bytes of intermediate files that may be kept in RAM_DIR,
+# and keep prevents the directories from being removed. The directories are
+# only created once a file is placed in them.
+class Workspace(object):
+    def __init__(self, path = None, ram = 0, keep = False, prefix = "tmp"):
+        if path is None:
+            path = os.environ.get(SCRATCH_ENV) or tempfile.gettempdir()
+        self.base = path
+        self.ram = ram
+        self.keep = keep
+        self.prefix = prefix + "-"
+        self.diskdir = None
+        self.ramdir = None
+        if ram and not (os.path.isdir(RAM_DIR) and os.access(RAM_DIR, os.W_OK)):
+            self.ram = 0
+        active.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, value, traceback):
+        self.cleanup()
+
+    # The directory on disk, created when first needed
+    def disk(self):
+        if self.diskdir is None:
+            self.diskdir = tempfile.mkdtemp(prefix = self.prefix, dir = self.base)
+        return self.diskdir
+
+    # Return whether size more bytes fit in RAM, both under the size cap and in
+    # the free space of RAM_DIR
+    def fitsInRam(self, size):
+        if not self.ram:
+            return False
+        used = 0
+        if self.ramdir is not None:
+            used = diskUsage(self.ramdir)
+        stat = os.statvfs(RAM_DIR)
+        return used + size <= self.ram and size < stat.f_bavail * stat.f_frsize
+
+    # Return the path of a scratch file. size is the expected size of the file in
+    # bytes; the file is placed in RAM if it fits, and on disk otherwise.
+    def path(self, name, size = 0):
+        if self.fitsInRam(size):
+            if self.ramdir is None:
+                self.ramdir = tempfile.mkdtemp(prefix = self.prefix, dir = RAM_DIR)
+            return os.path.join(self.ramdir, name)
+        return os.path.join(self.disk(), name)
+
+    # Move a finished scratch file to its final location, copying it if the two
+    # are on different filesystems
+    def move(self, src, dst):
+        try:
+            os.rename(src, dst)
+        except OSError:
+            shutil.move(src, dst)
+
+    # Remove the scratch directories, or report where they are if they are kept
+    def cleanup(self):
+        active.discard(self)
+        for path in (self.ramdir, self.diskdir):
+            if path is None:
+                continue
+            if self.keep:
+                print "Intermediate files kept in {0}".format(path)
+            else:
+                shutil.rmtree(path, ignore_errors = True)
+        self.ramdir = None
+        self.diskdir = None
+
+# Clean up the workspaces left over when a script exits
+def cleanupAll():
+    for work in list(active):
+        work.cleanup()
+
+atexit.register(cleanupAll)
+
+# Turn SIGTERM and SIGHUP into a normal exit in the main process, so that
+# workspaces are cleaned up when a script is killed
+def handleSignals():
+    pid = os.getpid()
+    def terminate(signum, frame):
+        if os.getpid() == pid:
+            sys.exit(128 + signum)
+        os._exit(128 + signum)
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, terminate)
@@ -0,0 +1,130 @@
+"""
+Reading of binary segmentation stacks. A segmentation is given either as a
+directory holding one image per slice, as a multi-page TIFF file, or as an MRC
+stack. Slices are checked to be binary and converted to boolean images in a
+single pass, resized with nearest-neighbor sampling or block-max pooling, which
+both keep them binary, and read ahead on a pool of threads so that decoding
+overlaps with the processing of earlier slices.
+
+Slices are returned in the row order of TIFF images, with the first row at the
+top; slices of MRC stacks are flipped in Y to match.
+"""
+
+import os
+import glob
+import threading
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from PIL import Image
+import mrcio
+
+# Methods of resizing slices
+RESIZE_METHODS = ("nearest", "max")
+
+class SegError(Exception):
+    pass
+
+# Convert a segmentation image to a boolean image. The image must hold at most one
+# value besides 0, which becomes True; this is checked in the same pass as the
+# conversion, by comparing the nonzero pixels to the first of them.
+def binarize(img, name = "Segmentation image"):
+    img = np.asarray(img)
+    if img.ndim == 3:
+        img = img[:, :, 0]
+    flat = img.ravel()
+    nonzero = flat != 0
+    first = np.argmax(nonzero)
+    if nonzero[first] and (flat[nonzero] != flat[first]).any():
+        raise SegError("{0} is not binary.".format(name))
+    return nonzero.reshape(img.shape)
+
+# Return, for each of n output pixels, the input pixel whose center is nearest to
+# its center, for an input of size m
+def nearestIndex(m, n):
+    return np.minimum(((np.arange(n) + 0.5) * m / n).astype(np.int64), m - 1)
+
+# Resize a boolean image to shape (rows, columns). With "nearest", each output
+# pixel takes the value of the input pixel at its center; with "max", it is set if
+# any input pixel of the block it covers is set, so that thin structures are kept
+# when shrinking. Images are only pooled along axes that shrink.
+def resize(img, shape, method = "nearest"):
+    if img.shape == tuple(shape):
+        return img
+    for axis, n in enumerate(shape):
+        m = img.shape[axis]
+        if method == "max" and n < m:
+            starts = (np.arange(n) * m) // n
+            img = np.logical_or.reduceat(img, starts, axis)
+        elif n != m:
+            img = img.take(nearestIndex(m, n), axis)
+    return img
+
+# A segmentation stack. path is a directory of images, one per slice in the sorted
+# order of their names, a multi-page TIFF file or an MRC file.
+class SegmentationStack(object):
+    def __init__(self, path):
+        self.path = path
+        self.files = None
+        self.mrc = None
+        self.local = threading.local()
+        if os.path.isdir(path):
+            self.files = sorted(glob.glob(os.path.join(path, "*")))
+            self.nslices = len(self.files)
+        elif os.path.splitext(path)[1].lower() in (".mrc", ".rec", ".st", ".ali"):
+            try:
+                self.mrc = mrcio.openStack(path)
+            except mrcio.MrcError as e:
+                raise SegError(str(e))
+            self.nslices = len(self.mrc)
+        else:
+            try:
+                self.nslices = getattr(Image.open(path), "n_frames", 1)
+            except IOError as e:
+                raise SegError("Cannot read {0}: {1}".format(path, e))
+
+    def __len__(self):
+        return self.nslices
+
+    # Read a slice as it is stored. The pages of a TIFF file are read through an
+    # image opened once by each thread, so that reading them in order does not
+    # go back to the first page each time.
+    def read(self, i):
+        if self.mrc is not None:
+            return self.mrc.slice(i)[::-1]
+        try:
+            if self.files is not None:
+                return np.asarray(Image.open(self.files[i]))
+            tif = getattr(self.local, "tif", None)
+            if tif is None or tif.tell() > i:
+                tif = self.local.tif = Image.open(self.path)
+            tif.seek(i)
+            return np.asarray(tif)
+        except (IOError, EOFError) as e:
+            raise SegError("Cannot read slice {0} of {1}: {2}".format(i, self.path, e))
+
+    # Read a slice as a boolean image of shape (rows, columns)
+    def load(self, i, shape, method = "nearest"):
+        img = binarize(self.read(i), "Segmentation slice {0}".format(i))
+        return resize(img, shape, method)
+
+# Load slices of a segmentation stack with a pool of threads threads, keeping up
+# to ahead slices in flight beyond the one being used. Yields (index, image) for
+# each index of indices, in order; errors in reading a slice are raised when its
+# turn comes. With no threads, the slices are loaded one at a time as they are
+# used.
+def prefetch(stack, indices, shape, method = "nearest", threads = 2, ahead = 4):
+    indices = list(indices)
+    if threads < 1:
+        for i in indices:
+            yield i, stack.load(i, shape, method)
+        return
+    pool = ThreadPool(threads)
+    try:
+        pending = []
+        for n, i in enumerate(indices):
+            while len(pending) <= ahead and n + len(pending) < len(indices):
+                j = indices[n + len(pending)]
+                pending.append(pool.apply_async(stack.load, (j, shape, method)))
+            yield i, pending.pop(0).get()
+    finally:
+        pool.terminate()